@@ -1,6 +1,7 @@
 # Prediction interface for Cog ⚙️
 # https://github.com/replicate/cog/blob/main/docs/python.md
 
+import json
 import os
 import sys
 import shutil
@@ -12,6 +13,8 @@ from cog import BasePredictor, Input, Path as CogPath
 sys.path.insert(0, os.path.abspath("src"))
 
 import main as m
+from index_cache import export_index_vectors
+from model_manager import model_manager
 
 
 def download_online_model(url, dir_name):
@@ -42,13 +45,29 @@ def download_online_model(url, dir_name):
                 os.path.join(extraction_folder, os.path.basename(member.filename)), "wb"
             ) as target:
                 shutil.copyfileobj(source, target)
+
+    for file in os.listdir(extraction_folder):
+        if file.endswith(".index"):
+            export_index_vectors(os.path.join(extraction_folder, file))
     print(f"[+] {dir_name} Model successfully downloaded!")
 
 
 class Predictor(BasePredictor):
     def setup(self) -> None:
         """Load the model into memory to make running multiple predictions efficient"""
-        pass
+        with open(os.path.join(m.mdxnet_models_dir, "model_data.json")) as infile:
+            mdx_model_params = json.load(infile)
+
+        # MDX sessions, HuBERT and RMVPE stay resident for the lifetime of the container.
+        # Voice models are loaded into the manager's bounded cache on first use, keyed by rvc_model.
+        self.models = model_manager
+        self.models.preload(mdx_model_params)
+        self.config = self.models.get_config()
+
+        default_voice = "Squidward"
+        if os.path.exists(os.path.join(m.rvc_models_dir, default_voice)):
+            rvc_model_path, _ = m.get_rvc_model(default_voice, False)
+            self.models.get_voice_model(default_voice, rvc_model_path, self.config)
 
     def predict(
         self,
@@ -0,0 +1,129 @@
+import argparse
+import inspect
+import json
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from main import mdxnet_models_dir, song_cover_pipeline
+from model_manager import model_manager
+from stage_meter import JobReport
+
+# song_cover_pipeline arguments a job can set; is_webui and progress belong to the WebUI, report to the runner
+JOB_PARAMS = [name for name in inspect.signature(song_cover_pipeline).parameters if name not in ('is_webui', 'progress', 'report')]
+
+
+def load_manifest(manifest_path):
+    """
+    Read a JSONL manifest with one job per line, e.g.
+    {"song_input": "song.mp3", "voice_model": "Squidward", "pitch_change": 0, "index_rate": 0.75}
+
+    Every key is an argument of `song_cover_pipeline`; "id" optionally names the job in the results.
+
+    Returns:
+        list: Jobs as dicts, with "id" defaulting to the line number
+    """
+    jobs = []
+    with open(manifest_path) as infile:
+        for line_number, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job.setdefault('id', line_number)
+            jobs.append(job)
+    return jobs
+
+
+def plan_jobs(jobs):
+    """
+    Group jobs by song so each song is separated once, and order them to reuse loaded voice models.
+
+    Jobs of the same song run one after the other in voice model order, so the stems, f0 and HuBERT
+    features come from the stage caches after the first job. Songs are then ordered by the voice models
+    they use, so consecutive songs tend to ask for voice models that are still loaded.
+
+    Returns:
+        list: Groups of jobs, each group being the jobs of one song
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job.get('song_input'), []).append(job)
+
+    groups = [sorted(group, key=lambda job: str(job.get('voice_model'))) for group in groups.values()]
+    return sorted(groups, key=lambda group: sorted({str(job.get('voice_model')) for job in group}))
+
+
+class BatchRunner:
+    """
+    Runs the jobs of a manifest in one process and appends a result line per job to `results_path`.
+
+    Song groups are spread over `workers` threads; models are shared through `model_manager`, so
+    extra workers mostly overlap separation, conversion and mixing of different songs.
+    """
+
+    def __init__(self, results_path, workers=1):
+        self.results_path = results_path
+        self.workers = workers
+        self._lock = threading.Lock()
+
+    def write_result(self, result):
+        with self._lock:
+            with open(self.results_path, 'a') as outfile:
+                outfile.write(json.dumps(result) + '\n')
+
+    def run_job(self, job):
+        start_time = time.time()
+        result = {'id': job['id'], 'song_input': job.get('song_input'), 'voice_model': job.get('voice_model')}
+        report = JobReport(job['id'])
+        try:
+            unknown_params = set(job) - set(JOB_PARAMS) - {'id'}
+            if unknown_params:
+                raise ValueError(f'Unknown job parameters: {", ".join(sorted(unknown_params))}')
+
+            params = {'keep_files': False, **{name: value for name, value in job.items() if name != 'id'}}
+            result['status'] = 'ok'
+            result['cover_path'] = song_cover_pipeline(**params, is_webui=0, report=report)
+        except Exception as e:
+            traceback.print_exc()
+            result['status'] = 'failed'
+            result['error'] = str(e)
+
+        result['duration'] = round(time.time() - start_time, 3)
+        result['stages'] = report.to_dict()['stages']
+        self.write_result(result)
+        return result
+
+    def run_group(self, group):
+        return [self.run_job(job) for job in group]
+
+    def run(self, jobs):
+        """
+        Returns:
+            list: Result of every job, in the order they were run
+        """
+        groups = plan_jobs(jobs)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch-worker') as executor:
+            return [result for results in executor.map(self.run_group, groups) for result in results]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate AI covers for every job of a JSONL manifest in a single process.', add_help=True)
+    parser.add_argument('-m', '--manifest', type=str, required=True, help='JSONL file with one job per line, whose keys are song_cover_pipeline arguments, e.g. {"song_input": "song.mp3", "voice_model": "Squidward", "pitch_change": 0}')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSONL file the result of every job is appended to. Defaults to <manifest>.results.jsonl')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of jobs run concurrently, each working on a different song')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='Number of CPU threads shared by vocal separation, HuBERT and index search. 0 uses all cores')
+    args = parser.parse_args()
+
+    if args.threads:
+        model_manager.set_thread_budget(args.threads)
+
+    with open(os.path.join(mdxnet_models_dir, 'model_data.json')) as infile:
+        model_manager.preload(json.load(infile))
+
+    results_path = args.output or f'{os.path.splitext(args.manifest)[0]}.results.jsonl'
+    results = BatchRunner(results_path, args.workers).run(load_manifest(args.manifest))
+    failed = sum(result['status'] != 'ok' for result in results)
+    print(f'[+] {len(results) - failed} covers generated, {failed} failed. Results written to {results_path}')
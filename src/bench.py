@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import faiss
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+from infer_pack.models import SynthesizerTrnMs768NSFsid
+from main import MDX_STAGES, post_process
+from mdx import mdx_separate, session_pool
+from model_manager import model_manager
+from rmvpe import E2E, RMVPE
+from rvc import build_inference_model
+from rvc_onnx import get_export_kwargs
+from stage_meter import StageMeter
+from vc_infer_pipeline import VC
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SR = 44100
+STAGES = ['separation', 'f0', 'hubert', 'retrieval', 'synthesis', 'effects', 'mixing']
+# model_data.json entry of the synthetic MDX model, with the spectrogram layout of UVR-MDX-NET-Voc_FT
+MDX_PARAMS = {'compensate': 1.035, 'mdx_dim_f_set': 3072, 'mdx_dim_t_set': 8, 'mdx_n_fft_scale_set': 7680, 'primary_stem': 'Vocals'}
+MDX_HASH = 'bench'
+
+
+def make_song(duration, sr=SR, seed=0):
+    """
+    Synthetic stereo song: a vibrato voice singing a few notes over chords and noise drums.
+
+    Returns:
+        np.ndarray: float32 wave with shape (2, duration * sr)
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+
+    notes = 220 * 2 ** (rng.integers(-5, 8, size=int(duration) + 1) / 12)
+    f0 = notes[t.astype(int)] * (1 + 0.01 * np.sin(2 * np.pi * 5.5 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    # syllables: 4 per second with short pauses between them
+    voice *= np.clip(np.sin(2 * np.pi * 2 * t) * 3, 0, 1)
+
+    chords = sum(np.sin(2 * np.pi * 110 * ratio * t) for ratio in (1, 1.25, 1.5, 2))
+    beat = (t * 2) % 1
+    drums = rng.standard_normal(t.shape[0]) * np.exp(-beat * 30)
+
+    left = 0.3 * voice + 0.15 * chords + 0.2 * drums
+    right = 0.3 * voice + 0.12 * chords + 0.25 * drums
+    wave = np.stack([left, right])
+    return (wave / np.abs(wave).max() * 0.9).astype(np.float32)
+
+
+class BenchHubert(torch.nn.Module):
+    """
+    Randomly initialised model with the layout of HuBERT base, as read by `VC.extract_features`:
+    a convolutional feature extractor downsampling 320x, a projection and a transformer encoder.
+    """
+
+    def __init__(self, layers=12, dim=768, conv_dim=512):
+        super().__init__()
+        convs, in_channels = [], 1
+        for kernel_size, stride in [(10, 5)] + [(3, 2)] * 4 + [(2, 2)] * 2:
+            convs += [torch.nn.Conv1d(in_channels, conv_dim, kernel_size, stride, bias=False), torch.nn.GELU()]
+            in_channels = conv_dim
+        self.feature_extractor = torch.nn.Sequential(*convs)
+        self.layer_norm = torch.nn.LayerNorm(conv_dim)
+        self.post_extract_proj = torch.nn.Linear(conv_dim, dim)
+        self.layers = torch.nn.ModuleList(
+            torch.nn.TransformerEncoderLayer(dim, 12, 4 * dim, dropout=0, activation='gelu', batch_first=True)
+            for _ in range(layers)
+        )
+        self.final_proj = torch.nn.Linear(dim, 256)
+
+    def forward_features(self, source):
+        return self.feature_extractor(source.unsqueeze(1))
+
+    def encoder(self, x, padding_mask=None, layer=None):
+        for i, block in enumerate(self.layers):
+            x = block(x, src_key_padding_mask=padding_mask)
+            if layer is not None and i >= layer:
+                break
+        return x, None
+
+
+class BenchMDXNet(torch.nn.Module):
+    """Small convolutional stand-in for an MDX-Net, mapping a (batch, 4, dim_f, dim_t) spectrogram to the same shape."""
+
+    def __init__(self, channels=16):
+        super().__init__()
+        self.net = torch.nn.Sequential(
+            torch.nn.Conv2d(4, channels, 3, padding=1),
+            torch.nn.ReLU(),
+            torch.nn.Conv2d(channels, channels, 3, padding=1),
+            torch.nn.ReLU(),
+            torch.nn.Conv2d(channels, 4, 1),
+        )
+
+    def forward(self, x):
+        return self.net(x)
+
+
+def make_synthesizer():
+    """Randomly initialised v2 40k synthesizer, with the checkpoint config layout of `get_vc`."""
+    with open(os.path.join(BASE_DIR, 'src', 'configs', '40k.json')) as infile:
+        hps = json.load(infile)
+    data, model = hps['data'], hps['model']
+    config = [
+        data['filter_length'] // 2 + 1, hps['train']['segment_size'] // data['hop_length'],
+        model['inter_channels'], model['hidden_channels'], model['filter_channels'], model['n_heads'], model['n_layers'],
+        model['kernel_size'], model['p_dropout'], model['resblock'], model['resblock_kernel_sizes'],
+        model['resblock_dilation_sizes'], model['upsample_rates'], model['upsample_initial_channel'],
+        model['upsample_kernel_sizes'], 1, model['gin_channels'], data['sampling_rate'],
+    ]
+    return config, data['sampling_rate']
+
+
+class BenchModels:
+    """Random models written to `model_dir`, so the benchmark needs no downloads."""
+
+    def __init__(self, model_dir, config, hubert_layers=12, index_size=20000, seed=0):
+        torch.manual_seed(seed)
+        self.config = config
+        device, is_half = config.device, config.is_half
+
+        self.mdx_path = os.path.join(model_dir, 'bench_mdx.onnx')
+        torch.onnx.export(BenchMDXNet(), torch.zeros(1, 4, MDX_PARAMS['mdx_dim_f_set'], 2 ** MDX_PARAMS['mdx_dim_t_set']),
+                          self.mdx_path, input_names=['input'], output_names=['output'], dynamic_axes={'input': [0], 'output': [0]},
+                          **get_export_kwargs())
+        providers = ['CUDAExecutionProvider'] if torch.cuda.is_available() else ['CPUExecutionProvider']
+        self.mdx_session = session_pool.get(self.mdx_path, providers, warmup_shape=(1, 4, MDX_PARAMS['mdx_dim_f_set'], 2 ** MDX_PARAMS['mdx_dim_t_set']))
+
+        hubert = BenchHubert(hubert_layers).eval().to(device)
+        self.hubert = hubert.half() if is_half else hubert.float()
+
+        rmvpe_path = os.path.join(model_dir, 'bench_rmvpe.pt')
+        torch.save(E2E(4, 1, (2, 2)).state_dict(), rmvpe_path)
+        self.rmvpe = RMVPE(rmvpe_path, is_half=is_half, device=device)
+
+        synthesizer_config, self.tgt_sr = make_synthesizer()
+        net_g = SynthesizerTrnMs768NSFsid(*synthesizer_config, is_half=is_half)
+        del net_g.enc_q
+        net_g = build_inference_model(net_g.eval()).to(device)
+        self.net_g = net_g.half() if is_half else net_g.float()
+
+        rng = np.random.default_rng(seed)
+        vectors = rng.standard_normal((index_size, 768)).astype(np.float32)
+        index = faiss.index_factory(768, f'IVF{int(np.sqrt(index_size))},Flat')
+        index.train(vectors)
+        index.add(vectors)
+        self.index_path = os.path.join(model_dir, 'bench.index')
+        faiss.write_index(index, self.index_path)
+
+    def make_vc(self):
+        vc = VC(self.tgt_sr, self.config)
+        # picked up by VC.compute_f0 instead of the RMVPE of model_manager
+        vc.model_rmvpe = self.rmvpe
+        return vc
+
+
+def run_once(models, song, work_dir, f0_method):
+    """Run every stage of a cover on `song` once, returns the StageMeter of the run."""
+    meter = StageMeter()
+    waves = {'orig': song}
+
+    with meter.measure('separation'):
+        for _, _, input_stem, output_stems, mdx_kwargs in MDX_STAGES:
+            separate_kwargs = {key: value for key, value in mdx_kwargs.items() if key not in ('suffix', 'invert_suffix')}
+            output_waves = mdx_separate({MDX_HASH: MDX_PARAMS}, models.mdx_path, waves[input_stem], ort_session=models.mdx_session,
+                                        model_hash=MDX_HASH, **separate_kwargs)
+            waves.update({name: wave for name, wave in zip(output_stems, output_waves) if name is not None})
+
+    stem_paths = {}
+    for name in ('instrumentals', 'backup_vocals'):
+        stem_paths[name] = os.path.join(work_dir, f'{name}.wav')
+        sf.write(stem_paths[name], waves[name].T, SR)
+    vocals = librosa.resample(waves['main_vocals_dereverb'].mean(axis=0), orig_sr=SR, target_sr=16000)
+
+    vc = models.make_vc()
+    audio_opt = vc.pipeline(models.hubert, models.net_g, 0, vocals, '', [0, 0, 0], 0, f0_method, models.index_path, 0.5, 1, 3,
+                            models.tgt_sr, 0, 0.25, 'v2', 0.33, 128, meter=meter)
+    post_process(audio_opt.astype(np.float32) / 32768, models.tgt_sr, stem_paths['backup_vocals'], stem_paths['instrumentals'],
+                 os.path.join(work_dir, 'cover.wav'), 'wav', meter=meter)
+    return meter
+
+
+def run_bench(duration=30, repeat=3, f0_method='rmvpe', hubert_layers=12):
+    """
+    Benchmark the stages of a cover on a synthetic song with random models.
+
+    Every stage keeps its fastest run out of `repeat`, which filters out warm-up and noise from other
+    processes, and the highest peak RSS of any run.
+
+    Returns:
+        dict: JSON serializable report
+    """
+    config = model_manager.get_config('cuda:0', True)
+    work_dir = tempfile.mkdtemp(prefix='aicovergen-bench-')
+    try:
+        models = BenchModels(work_dir, config, hubert_layers)
+        song = make_song(duration)
+        runs = [run_once(models, song, work_dir, f0_method).stages for _ in range(repeat)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    stages = {}
+    for name in STAGES:
+        measured = [run[name] for run in runs if name in run]
+        if not measured:
+            continue
+        fastest = min(measured, key=lambda stage: stage['wall_time'])
+        stages[name] = {
+            'wall_time': round(fastest['wall_time'], 4),
+            'cpu_time': round(fastest['cpu_time'], 4),
+            'real_time_factor': round(fastest['wall_time'] / duration, 4),
+            'peak_rss': max(stage['peak_rss'] for stage in measured),
+        }
+    total = sum(stage['wall_time'] for stage in stages.values())
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'device': config.device,
+        'is_half': config.is_half,
+        'threads': torch.get_num_threads(),
+        'duration': duration,
+        'repeat': repeat,
+        'f0_method': f0_method,
+        'hubert_layers': hubert_layers,
+        'segments': {'x_pad': config.x_pad, 'x_query': config.x_query, 'x_center': config.x_center, 'x_max': config.x_max, 'vc_batch_size': config.vc_batch_size},
+        'stages': stages,
+        'total': {'wall_time': round(total, 4), 'real_time_factor': round(total / duration, 4)},
+    }
+
+
+def compare_reports(report, baseline, tolerance=0.1):
+    """
+    Compare the stage wall times of a report with a baseline report.
+
+    Args:
+        tolerance: (float) Relative change below which a stage counts as unchanged
+
+    Returns:
+        dict: Per stage (and total) baseline wall time, ratio and status: regression, improvement or unchanged
+    """
+    comparison = {}
+    entries = {**report['stages'], 'total': report['total']}
+    baseline_entries = {**baseline.get('stages', {}), 'total': baseline.get('total', {})}
+    for name, entry in entries.items():
+        baseline_time = baseline_entries.get(name, {}).get('wall_time')
+        if not baseline_time:
+            continue
+        ratio = entry['wall_time'] / baseline_time
+        status = 'regression' if ratio > 1 + tolerance else 'improvement' if ratio < 1 - tolerance else 'unchanged'
+        comparison[name] = {'baseline_wall_time': baseline_time, 'ratio': round(ratio, 4), 'status': status}
+    return comparison
+
+
+def print_report(report):
+    comparison = report.get('baseline', {}).get('stages', {})
+    print(f'[+] {report["duration"]}s synthetic song on {report["device"]}, best of {report["repeat"]}')
+    print(f'{"stage":<12}{"wall (s)":>10}{"rtf":>9}{"peak rss":>12}{"vs baseline":>14}')
+    for name, entry in {**report['stages'], 'total': report['total']}.items():
+        peak_rss = f'{entry["peak_rss"] / 1024 ** 2:.0f} MB' if 'peak_rss' in entry else ''
+        change = f'{comparison[name]["ratio"]:.2f}x {comparison[name]["status"]}' if name in comparison else ''
+        print(f'{name:<12}{entry["wall_time"]:>10.3f}{entry["real_time_factor"]:>9.3f}{peak_rss:>12}  {change}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark every stage of a cover on a synthetic song with random models, offline.', add_help=True)
+    parser.add_argument('-d', '--duration', type=int, default=30, help='Length of the synthetic song in seconds')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs, the fastest run of each stage is reported')
+    parser.add_argument('-palgo', '--pitch-detection-algo', type=str, default='rmvpe', help='Pitch detection algorithm')
+    parser.add_argument('--hubert-layers', type=int, default=12, help='Transformer layers of the random HuBERT, 12 like HuBERT base')
+    parser.add_argument('-o', '--output', type=str, default='bench_report.json', help='JSON file the report is written to')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='Report of an earlier run to compare with, e.g. one made on the main branch')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown of a stage reported as a regression')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='Number of CPU threads shared by vocal separation, HuBERT and index search. 0 uses all cores')
+    args = parser.parse_args()
+
+    if args.threads:
+        model_manager.set_thread_budget(args.threads)
+
+    report = run_bench(args.duration, args.repeat, args.pitch_detection_algo, args.hubert_layers)
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        report['baseline'] = {'path': args.baseline, 'created': baseline.get('created'), 'tolerance': args.tolerance,
+                              'stages': compare_reports(report, baseline, args.tolerance)}
+
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print_report(report)
+    print(f'[+] Report written to {args.output}')
+
+    regressions = [name for name, entry in report.get('baseline', {}).get('stages', {}).items() if entry['status'] == 'regression']
+    if regressions:
+        print(f'[!] Slower than the baseline: {", ".join(regressions)}')
+        sys.exit(1)
@@ -0,0 +1,157 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES_PATH = os.path.join(BASE_DIR, 'song_output', 'cache', 'device_profiles.json')
+
+GIB = 1024 ** 3
+# memory held by HuBERT, RMVPE and a voice model, which is not available to the segments
+MODEL_MEMORY = 1.5 * GIB
+# fraction of the free memory the segments may use, the rest absorbs allocator fragmentation
+MEMORY_HEADROOM = 0.8
+# memory used per second of segment (padding included) until the device is calibrated, from the former
+# fixed configs: 86 s long segments on 6G cards at half precision and 52 s on 5G cards at single precision
+DEFAULT_MEMORY_PER_SECOND = {
+    True: (6 * GIB * MEMORY_HEADROOM - MODEL_MEMORY) / 86,
+    False: (5 * GIB * MEMORY_HEADROOM - MODEL_MEMORY) / 52,
+}
+MIN_SEGMENT, MAX_SEGMENT = 10, 60
+CALIBRATION_SECONDS = 4
+
+_lock = threading.Lock()
+
+
+def get_default_profile(is_half):
+    return {'memory_per_second': DEFAULT_MEMORY_PER_SECOND[is_half], 'memory_overhead': 0, 'calibrated': False}
+
+
+def get_profile_key(device, device_name, is_half):
+    """Profiles are stored per host, device model, precision and torch version."""
+    precision = 'half' if is_half else 'float'
+    return f'{socket.gethostname()}|{device}|{device_name}|{precision}|torch {torch.__version__}'
+
+
+def load_profile(key):
+    try:
+        with open(PROFILES_PATH) as infile:
+            return json.load(infile).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_profile(key, profile):
+    with _lock:
+        try:
+            with open(PROFILES_PATH) as infile:
+                profiles = json.load(infile)
+        except (OSError, ValueError):
+            profiles = {}
+        profiles[key] = profile
+        os.makedirs(os.path.dirname(PROFILES_PATH), exist_ok=True)
+        tmp_path = f'{PROFILES_PATH}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(profiles, outfile, indent=2)
+        os.replace(tmp_path, PROFILES_PATH)
+
+
+def get_free_memory(device):
+    """Free memory in bytes of a CUDA device, or available system memory for the other devices."""
+    if str(device).startswith('cuda'):
+        free, total = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        # MemAvailable counts the page cache the kernel can reclaim, unlike the free pages
+        with open('/proc/meminfo') as infile:
+            for line in infile:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 8 * GIB
+
+
+def plan_segments(memory_budget, memory_per_second, use_batches):
+    """
+    Pick the segment sizes of `VC.pipeline` that fit a memory budget.
+
+    The longest segment the pipeline converts is `x_center + 2 * x_query` seconds plus `x_pad` seconds of
+    padding on each side. Longer segments spend less time on padding, so the segment length is the
+    largest that fits the budget, up to MAX_SEGMENT seconds; padding drops from 3 to 1 second when the
+    budget is tight. Memory left once segments reach MAX_SEGMENT is spent on batching several segments.
+
+    Args:
+        memory_budget: (float) Bytes available to the converted segments
+        memory_per_second: (float) Bytes used per second of segment
+        use_batches: (bool) Convert several segments at once if the budget allows it, which only pays off on GPU
+
+    Returns:
+        dict: x_pad, x_query, x_center and x_max in seconds, and vc_batch_size
+    """
+    longest = memory_budget / memory_per_second
+    x_pad = 3 if longest >= MAX_SEGMENT * 4 / 3 + 6 else 1
+    # x_query is a sixth of x_center, so the longest segment is 4/3 x_center plus the padding
+    x_center = int(min(MAX_SEGMENT, max(MIN_SEGMENT, (longest - 2 * x_pad) * 3 / 4)))
+    x_query = max(1, x_center // 6)
+    x_max = x_center + max(2, x_center // 12)
+
+    vc_batch_size = 1
+    if use_batches:
+        vc_batch_size = max(1, int(longest // (x_center + 2 * x_query + 2 * x_pad)))
+    return {'x_pad': x_pad, 'x_query': x_query, 'x_center': x_center, 'x_max': x_max, 'vc_batch_size': vc_batch_size}
+
+
+def measure_conversion(vc, hubert_model, net_g, version, if_f0, seconds):
+    """Convert `seconds` of a synthetic voice, returns the peak CUDA memory it used and its duration."""
+    device = torch.device(vc.device)
+    t = np.arange(seconds * vc.sr) / vc.sr
+    audio = (0.3 * np.sin(2 * np.pi * 220 * t) + 0.01 * np.random.default_rng(0).standard_normal(t.shape[0])).astype(np.float32)
+    p_len = audio.shape[0] // vc.window
+
+    pitch, pitchf = None, None
+    if if_f0 == 1:
+        pitch = torch.full((1, p_len), 100, device=device).long()
+        pitchf = torch.full((1, p_len), 220.0, device=device).float()
+    sid = torch.tensor([0], device=device).long()
+
+    torch.cuda.synchronize(device)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    base_memory = torch.cuda.memory_allocated(device)
+    start_time = time.time()
+    vc.vc(hubert_model, net_g, sid, audio, pitch, pitchf, [0, 0, 0], None, None, 0, version, 0.33)
+    torch.cuda.synchronize(device)
+    elapsed = time.time() - start_time
+    peak_memory = torch.cuda.max_memory_allocated(device) - base_memory
+    torch.cuda.empty_cache()
+    return peak_memory, elapsed
+
+
+def calibrate(vc, hubert_model, net_g, version, if_f0, seconds=CALIBRATION_SECONDS):
+    """
+    Measure the memory a loaded voice model uses per second of segment on CUDA.
+
+    Two synthetic segments of `seconds` and `2 * seconds` are converted: the difference of their peak
+    memory gives the memory per second, the remainder the fixed overhead of a conversion (e.g. cuDNN
+    workspaces). The first conversion also warms the device up before the timed one.
+
+    Returns:
+        dict: memory_per_second and memory_overhead in bytes, and real_time_factor, the conversion time
+        per second of audio
+    """
+    short_memory, _ = measure_conversion(vc, hubert_model, net_g, version, if_f0, seconds)
+    long_memory, elapsed = measure_conversion(vc, hubert_model, net_g, version, if_f0, 2 * seconds)
+    memory_per_second = max(long_memory - short_memory, 1) / seconds
+    return {
+        'memory_per_second': memory_per_second,
+        'memory_overhead': max(0.0, short_memory - memory_per_second * seconds),
+        'real_time_factor': elapsed / (2 * seconds),
+    }
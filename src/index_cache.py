@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def get_vectors_path(index_path):
+    return f'{os.path.splitext(index_path)[0]}.vectors.npy'
+
+
+def export_index_vectors(index_path, index=None):
+    """
+    Write the vectors stored in a faiss index to a sidecar .npy file next to it
+
+    The sidecar is memory-mapped at inference time instead of calling `index.reconstruct_n` on every run.
+
+    Args:
+        index_path: (str) Path to the .index file
+        index: (faiss.Index) Already loaded index, read from `index_path` if None
+
+    Returns:
+        str: Path to the sidecar file
+    """
+    vectors_path = get_vectors_path(index_path)
+    if os.path.exists(vectors_path) and os.path.getmtime(vectors_path) >= os.path.getmtime(index_path):
+        return vectors_path
+
+    index = faiss.read_index(index_path) if index is None else index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    tmp_path = f'{vectors_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, vectors.astype(np.float32, copy=False))
+    os.replace(tmp_path, vectors_path)
+    return vectors_path
+
+
+class IndexCache:
+    """
+    Least recently used cache of loaded faiss indexes with their memory-mapped retrieval vectors.
+
+    Memory is accounted as the size of each index file, which is what faiss keeps resident after
+    `read_index`. The vectors are memory-mapped, so they live in the page cache and are shared
+    between every job using the same voice model.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, index_path):
+        """
+        Returns:
+            tuple: (faiss index, memory-mapped vectors with shape (ntotal, d))
+        """
+        key = (os.path.abspath(index_path), os.path.getmtime(index_path))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][:2]
+
+            index = faiss.read_index(index_path)
+            big_npy = np.load(export_index_vectors(index_path, index), mmap_mode='r')
+            self._entries[key] = (index, big_npy, os.path.getsize(index_path))
+            while len(self._entries) > 1 and self.memory_usage() > self.max_bytes:
+                self._entries.popitem(last=False)
+            return index, big_npy
+
+    def memory_usage(self):
+        return sum(size for _, _, size in self._entries.values())
+
+
+index_cache = IndexCache()
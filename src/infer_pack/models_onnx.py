@@ -573,7 +573,8 @@ class SynthesizerTrnMsNSFsidM(nn.Module):
         self.gin_channels = gin_channels
         # self.hop_length = hop_length#
         self.spk_embed_dim = spk_embed_dim
-        if self.gin_channels == 256:
+        # v1 models use 256 dim phone features and v2 models 768; both have gin_channels == 256
+        if kwargs.get("version", "v1" if self.gin_channels == 256 else "v2") == "v1":
             self.enc_p = TextEncoder256(
                 inter_channels,
                 hidden_channels,
@@ -1,9 +1,10 @@
 import argparse
-import gc
 import hashlib
 import json
+import math
 import os
 import shlex
+import shutil
 import subprocess
 from contextlib import suppress
 from urllib.parse import urlparse, parse_qs
@@ -14,12 +15,15 @@ import numpy as np
 import soundfile as sf
 import sox
 import yt_dlp
-from pedalboard import Pedalboard, Reverb, Compressor, HighpassFilter
-from pedalboard.io import AudioFile
-from pydub import AudioSegment
+from pedalboard import Pedalboard, Reverb, Compressor, HighpassFilter, PitchShift
+from scipy.signal import resample_poly
 
-from mdx import run_mdx
-from rvc import Config, load_hubert, get_vc, rvc_infer
+from mdx import get_stem_names, mdx_separate
+from model_manager import model_manager
+from my_utils import load_audio
+from rvc import rvc_infer
+from stage_cache import StageCache
+from stage_meter import JobReport, measure
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -27,6 +31,22 @@ mdxnet_models_dir = os.path.join(BASE_DIR, 'mdxnet_models')
 rvc_models_dir = os.path.join(BASE_DIR, 'rvc_models')
 output_dir = os.path.join(BASE_DIR, 'song_output')
 
+stage_cache = StageCache(os.path.join(output_dir, 'cache'))
+# HuBERT features of converted vocals, shared by every voice model
+feature_cache = StageCache(os.path.join(output_dir, 'cache', 'hubert'), max_bytes=5 * 1024 ** 3)
+# one JobReport per line, see multi_voice_cover_pipeline
+job_log_path = os.path.join(output_dir, 'job_reports.jsonl')
+
+# frames per block read, mixed and encoded by combine_audio, 10 s at 44.1 kHz
+MIX_BLOCK_FRAMES = 441000
+
+MDX_STAGES = [
+    # (progress message, model name, input stem, output stems (main, inverted), run_mdx kwargs)
+    ('[~] Separating Vocals from Instrumental...', 'UVR-MDX-NET-Voc_FT.onnx', 'orig', ('vocals', 'instrumentals'), {'denoise': True}),
+    ('[~] Separating Main Vocals from Backup Vocals...', 'UVR_MDXNET_KARA_2.onnx', 'vocals', ('backup_vocals', 'main_vocals'), {'suffix': 'Backup', 'invert_suffix': 'Main', 'denoise': True}),
+    ('[~] Applying DeReverb to Vocals...', 'Reverb_HQ_By_FoxJoy.onnx', 'main_vocals', (None, 'main_vocals_dereverb'), {'invert_suffix': 'DeReverb', 'exclude_main': True, 'denoise': True}),
+]
+
 
 def get_youtube_video_id(url, ignore_playlist=True):
     """
@@ -102,26 +122,6 @@ def get_rvc_model(voice_model, is_webui):
     return os.path.join(model_dir, rvc_model_filename), os.path.join(model_dir, rvc_index_filename) if rvc_index_filename else ''
 
 
-def get_audio_paths(song_dir):
-    orig_song_path = None
-    instrumentals_path = None
-    main_vocals_dereverb_path = None
-    backup_vocals_path = None
-
-    for file in os.listdir(song_dir):
-        if file.endswith('_Instrumental.wav'):
-            instrumentals_path = os.path.join(song_dir, file)
-            orig_song_path = instrumentals_path.replace('_Instrumental', '')
-
-        elif file.endswith('_Vocals_Main_DeReverb.wav'):
-            main_vocals_dereverb_path = os.path.join(song_dir, file)
-
-        elif file.endswith('_Vocals_Backup.wav'):
-            backup_vocals_path = os.path.join(song_dir, file)
-
-    return orig_song_path, instrumentals_path, main_vocals_dereverb_path, backup_vocals_path
-
-
 def convert_to_stereo(audio_path):
     wave, sr = librosa.load(audio_path, mono=False, sr=44100)
 
@@ -135,16 +135,42 @@ def convert_to_stereo(audio_path):
         return audio_path
 
 
-def pitch_shift(audio_path, pitch_change):
-    output_path = f'{os.path.splitext(audio_path)[0]}_p{pitch_change}.wav'
-    if not os.path.exists(output_path):
-        y, sr = sf.read(audio_path)
-        tfm = sox.Transformer()
-        tfm.pitch(pitch_change)
-        y_shifted = tfm.build_array(input_array=y, sample_rate_in=sr)
-        sf.write(output_path, y_shifted, sr)
+def pitch_shift(wave, sr, pitch_change, method='sox'):
+    """
+    Shift the pitch of a (frames, channels) wave by `pitch_change` semitones, with sox or with Rubber Band
+    through pedalboard's PitchShift.
+    """
+    if method == 'rubberband':
+        return PitchShift(semitones=pitch_change)(wave.T, sr).T
+    tfm = sox.Transformer()
+    tfm.pitch(pitch_change)
+    return tfm.build_array(input_array=wave, sample_rate_in=sr)
+
+
+def get_shift_key(stem_path, pitch_change, method='sox'):
+    return stage_cache.make_key('pitch_shift', stem_path, pitch_change, method)
 
-    return output_path
+
+def get_shifted_stem(stem_path, pitch_change, method='sox', stage=None):
+    """
+    Pitch shifted copy of a stem, kept in the stage cache so re-mixes of the song do not shift it again.
+
+    Stems live in content-addressed cache entries, so their path identifies their content.
+
+    Returns:
+        str: Path of the shifted stem
+    """
+    key = get_shift_key(stem_path, pitch_change, method)
+    entry = stage_cache.get(key)
+    if stage is not None:
+        stage.cache_hit(entry is not None)
+    if entry is not None:
+        return entry['files']['stem']
+
+    wave, sr = sf.read(stem_path, dtype='float32', always_2d=True)
+    shifted = pitch_shift(wave, sr, pitch_change, method)
+    filename = f'{os.path.splitext(os.path.basename(stem_path))[0]}_p{pitch_change}.wav'
+    return stage_cache.put_waves(key, {'stem': (filename, shifted.T, sr)}, {'stage': 'pitch_shift'}).result()['stem']
 
 
 def get_hash(filepath):
@@ -163,49 +189,116 @@ def display_progress(message, percent, is_webui, progress=None):
         print(message)
 
 
-def preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress=None):
+def run_mdx_shared(mdx_model_params, model_name, wave, **kwargs):
+    model_path = os.path.join(mdxnet_models_dir, model_name)
+    ort_session = model_manager.get_mdx_session(model_path, mdx_model_params)
+    model_hash = model_manager.get_mdx_hash(model_path)
+    return mdx_separate(mdx_model_params, model_path, wave, ort_session=ort_session, model_hash=model_hash, **kwargs)
+
+
+def get_orig_song(song_input, input_type, is_webui, progress=None, meter=None):
     keep_orig = False
     if input_type == 'yt':
         display_progress('[~] Downloading song...', 0, is_webui, progress)
         song_link = song_input.split('&')[0]
-        orig_song_path = yt_download(song_link)
+        with measure(meter, 'download'):
+            orig_song_path = yt_download(song_link)
     elif input_type == 'local':
         orig_song_path = song_input
         keep_orig = True
     else:
         orig_song_path = None
 
-    song_output_dir = os.path.join(output_dir, song_id)
-    orig_song_path = convert_to_stereo(orig_song_path)
-
-    display_progress('[~] Separating Vocals from Instrumental...', 0.1, is_webui, progress)
-    vocals_path, instrumentals_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'UVR-MDX-NET-Voc_FT.onnx'), orig_song_path, denoise=True, keep_orig=keep_orig)
-
-    display_progress('[~] Separating Main Vocals from Backup Vocals...', 0.2, is_webui, progress)
-    backup_vocals_path, main_vocals_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'UVR_MDXNET_KARA_2.onnx'), vocals_path, suffix='Backup', invert_suffix='Main', denoise=True)
-
-    display_progress('[~] Applying DeReverb to Vocals...', 0.3, is_webui, progress)
-    _, main_vocals_dereverb_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'Reverb_HQ_By_FoxJoy.onnx'), main_vocals_path, invert_suffix='DeReverb', exclude_main=True, denoise=True)
-
-    return orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path
-
-
-def voice_change(voice_model, vocals_path, output_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui):
+    with measure(meter, 'stereo_conversion'):
+        return convert_to_stereo(orig_song_path), keep_orig
+
+
+def get_stage_keys(song_id, input_type, mdx_model_params):
+    # each stage is keyed by its parent stage, so the chain is rooted at the input content hash (or YouTube id)
+    stage_keys = []
+    parent_key = f'{input_type}:{song_id}'
+    for _, model_name, _, _, mdx_kwargs in MDX_STAGES:
+        model_hash = model_manager.get_mdx_hash(os.path.join(mdxnet_models_dir, model_name))
+        parent_key = stage_cache.make_key(parent_key, model_hash, mdx_model_params.get(model_hash), mdx_kwargs)
+        stage_keys.append(parent_key)
+
+    return stage_keys
+
+
+def preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress=None, mdx_batch_size=None, meter=None):
+    stage_keys = get_stage_keys(song_id, input_type, mdx_model_params)
+    stage_inputs = {input_stem for _, _, input_stem, _, _ in MDX_STAGES}
+    stems, stem_names, waves, pending_writes = {}, {}, {}, []
+    orig_song_name = None
+
+    for stage, (message, model_name, input_stem, output_stems, mdx_kwargs) in enumerate(MDX_STAGES):
+        stage_name = f'mdx_{os.path.splitext(model_name)[0]}'
+        entry = stage_cache.get(stage_keys[stage])
+        if entry is not None:
+            with measure(meter, stage_name) as record:
+                record.cache_hit()
+            display_progress(f'[~] Using cached {", ".join(name for name in output_stems if name)}...', 0.1 * (stage + 1), is_webui, progress)
+            stems.update(entry['files'])
+            stem_names.update({name: os.path.splitext(os.path.basename(path))[0] for name, path in entry['files'].items()})
+            orig_song_name = entry['meta']['orig_song_name']
+            continue
+
+        # stems are handed from one separation to the next in memory; only cache hits are read back from disk
+        if input_stem == 'orig':
+            orig_song_path, keep_orig = get_orig_song(song_input, input_type, is_webui, progress, meter)
+            orig_song_name = stem_names['orig'] = os.path.splitext(os.path.basename(orig_song_path))[0]
+            with measure(meter, 'decode'):
+                waves['orig'], _ = librosa.load(orig_song_path, mono=False, sr=44100)
+            if not keep_orig:
+                os.remove(orig_song_path)
+        elif input_stem not in waves:
+            with measure(meter, 'decode'):
+                waves[input_stem], _ = librosa.load(stems[input_stem], mono=False, sr=44100)
+
+        display_progress(message, 0.1 * (stage + 1), is_webui, progress)
+        separate_kwargs = {key: value for key, value in mdx_kwargs.items() if key not in ('suffix', 'invert_suffix')}
+        with measure(meter, stage_name) as record:
+            record.cache_hit(False)
+            output_waves = run_mdx_shared(mdx_model_params, model_name, waves.pop(input_stem), batch_size=mdx_batch_size, **separate_kwargs)
+
+        model_hash = model_manager.get_mdx_hash(os.path.join(mdxnet_models_dir, model_name))
+        output_names = get_stem_names(mdx_model_params[model_hash]['primary_stem'], stem_names[input_stem], mdx_kwargs.get('suffix'), mdx_kwargs.get('invert_suffix'))
+        to_write = {}
+        for name, stem_name, wave in zip(output_stems, output_names, output_waves):
+            if name is None:
+                continue
+            stem_names[name] = stem_name
+            to_write[name] = (f'{stem_name}.wav', wave, 44100)
+            if name in stage_inputs:
+                waves[name] = wave
+
+        # the cache writes the stems on a background thread while the next separation runs
+        pending_writes.append(stage_cache.put_waves(stage_keys[stage], to_write, {'orig_song_name': orig_song_name}, protect=stage_keys))
+
+    for write in pending_writes:
+        stems.update(write.result())
+
+    return orig_song_name, stems
+
+
+def voice_change(voice_model, vocals_path, output_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui, audio=None, meter=None):
     rvc_model_path, rvc_index_path = get_rvc_model(voice_model, is_webui)
-    device = 'cuda:0'
-    config = Config(device, True)
-    hubert_model = load_hubert(device, config.is_half, os.path.join(rvc_models_dir, 'hubert_base.pt'))
-    cpt, version, net_g, tgt_sr, vc = get_vc(device, config.is_half, config, rvc_model_path)
+    config = model_manager.get_config('cuda:0', True)
+    hubert_model = model_manager.get_hubert(config.device, config.is_half)
+    with measure(meter, 'load_voice_model'):
+        cpt, version, net_g, tgt_sr, vc = model_manager.get_voice_model(voice_model, rvc_model_path, config)
 
     # convert main vocals
-    rvc_infer(rvc_index_path, index_rate, vocals_path, output_path, pitch_change, f0_method, cpt, version, net_g, filter_radius, tgt_sr, rms_mix_rate, protect, crepe_hop_length, vc, hubert_model)
-    del hubert_model, cpt
-    gc.collect()
+    return rvc_infer(rvc_index_path, index_rate, vocals_path, output_path, pitch_change, f0_method, cpt, version, net_g, filter_radius, tgt_sr, rms_mix_rate, protect, crepe_hop_length, vc, hubert_model, cache=stage_cache, feature_cache=feature_cache, audio=audio, meter=meter), tgt_sr
 
 
-def add_audio_effects(audio_path, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping):
-    output_path = f'{os.path.splitext(audio_path)[0]}_mixed.wav'
+def add_audio_effects(vocals, sr, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping):
+    """
+    Apply the effects chain to mono float32 vocals, in blocks of MIX_BLOCK_FRAMES.
 
+    Returns:
+        np.ndarray: Effected vocals, same shape as `vocals`
+    """
     # Initialize audio effects plugins
     board = Pedalboard(
         [
@@ -215,33 +308,184 @@ def add_audio_effects(audio_path, reverb_rm_size, reverb_wet, reverb_dry, reverb
          ]
     )
 
-    with AudioFile(audio_path) as f:
-        with AudioFile(output_path, 'w', f.samplerate, f.num_channels) as o:
-            # Read one second of audio at a time, until the file is empty:
-            while f.tell() < f.frames:
-                chunk = f.read(int(f.samplerate))
-                effected = board(chunk, f.samplerate, reset=False)
-                o.write(effected)
+    effected = np.empty_like(vocals)
+    for start in range(0, vocals.shape[0], MIX_BLOCK_FRAMES):
+        # the plugins keep their state between blocks, so the reverb tail carries over
+        effected[start:start + MIX_BLOCK_FRAMES] = board(vocals[None, start:start + MIX_BLOCK_FRAMES], sr, reset=False)[0]
+    return effected
 
-    return output_path
 
+def read_blocks(audio_path, sr, block_frames=MIX_BLOCK_FRAMES):
+    """
+    Read an audio file block by block, resampled to `sr`.
+
+    Resampling uses `resample_poly` on each block with enough context around it for the filter, so the
+    blocks join into the same signal as resampling the whole file at once.
 
-def combine_audio(audio_paths, output_path, main_gain, backup_gain, inst_gain, output_format):
-    main_vocal_audio = AudioSegment.from_wav(audio_paths[0]) - 4 + main_gain
-    backup_vocal_audio = AudioSegment.from_wav(audio_paths[1]) - 6 + backup_gain
-    instrumental_audio = AudioSegment.from_wav(audio_paths[2]) - 7 + inst_gain
-    main_vocal_audio.overlay(backup_vocal_audio).overlay(instrumental_audio).export(output_path, format=output_format)
+    Yields:
+        np.ndarray: float32 blocks with shape (frames, channels)
+    """
+    with sf.SoundFile(audio_path) as f:
+        if f.samplerate == sr:
+            yield from f.blocks(block_frames, dtype='float32', always_2d=True)
+            return
+
+        common = math.gcd(sr, f.samplerate)
+        up, down = sr // common, f.samplerate // common
+        # whole multiples of `down` input frames map to whole output frames; the context covers the
+        # filter of resample_poly, which spans 10 * max(up, down) frames of the upsampled signal on each side
+        block_frames = max(1, block_frames // down) * down
+        context = math.ceil((10 * max(up, down) / up + 1) / down) * down
+        total_frames = math.ceil(f.frames * up / down)
+        for start in range(0, f.frames, block_frames):
+            f.seek(max(0, start - context))
+            block = f.read(min(f.frames, start + block_frames + context) - max(0, start - context), dtype='float32', always_2d=True)
+            pad_before = context - min(context, start)
+            pad_after = start + block_frames + context - f.frames if start + block_frames + context > f.frames else 0
+            block = np.pad(block, ((pad_before, pad_after), (0, 0)))
+            resampled = resample_poly(block, up, down, axis=0)[context * up // down: (context + block_frames) * up // down]
+            yield resampled[:total_frames - start * up // down].astype(np.float32, copy=False)
+
+
+def write_audio(wave, sr, output_path, output_format):
+    """Encode a float (frames, channels) wave: wav and flac with soundfile, other formats by piping raw samples to ffmpeg."""
+    if output_format in ('wav', 'flac'):
+        sf.write(output_path, wave, sr, subtype='PCM_16')
+        return
+
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'f32le', '-ar', str(sr), '-ac', str(wave.shape[1]), '-i', 'pipe:0', '-f', output_format, output_path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    for start in range(0, wave.shape[0], MIX_BLOCK_FRAMES):
+        process.stdin.write(wave[start:start + MIX_BLOCK_FRAMES].tobytes())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f'ffmpeg failed to encode {output_path}.')
+
+
+def combine_audio(main_vocals, main_sr, audio_paths, output_path, main_gain, backup_gain, inst_gain, output_format):
+    """
+    Mix the AI main vocals with the backup vocals and instrumentals into the cover.
+
+    The mix is made at the sample rate of the instrumentals in one preallocated buffer: the main vocals
+    are resampled once and the stems are streamed into it block by block, so the only full-length copy
+    of the song in memory is the mix itself. The mix is as long as the main vocals and clipped to full scale.
+
+    Args:
+        main_vocals: (np.ndarray) Mono float32 AI vocals
+        main_sr: (int) Sample rate of `main_vocals`
+        audio_paths: (list) Paths of the backup vocals and the instrumentals
+    """
+    main_gain, gains = -4 + main_gain, [-6 + backup_gain, -7 + inst_gain]
+    infos = [sf.info(audio_path) for audio_path in audio_paths]
+    sr = infos[-1].samplerate
+    if main_sr != sr:
+        common = math.gcd(sr, main_sr)
+        main_vocals = resample_poly(main_vocals, sr // common, main_sr // common).astype(np.float32, copy=False)
+    frames = main_vocals.shape[0]
+    mix = np.empty((frames, max(info.channels for info in infos)), dtype=np.float32)
+    mix[:] = main_vocals[:, None] * np.float32(10 ** (main_gain / 20))
+
+    for audio_path, gain in zip(audio_paths, gains):
+        position = 0
+        for block in read_blocks(audio_path, sr):
+            block = block[:frames - position]
+            # mono blocks are broadcast to every channel of the mix
+            mix[position:position + block.shape[0]] += block * np.float32(10 ** (gain / 20))
+            position += block.shape[0]
+            if position >= frames:
+                break
+
+    np.clip(mix, -1, 1, out=mix)
+    write_audio(mix, sr, output_path, output_format)
+
+
+def post_process(vocals, vocals_sr, backup_vocals_path, instrumentals_path, output_path, output_format='mp3', main_gain=0,
+                 backup_gain=0, inst_gain=0, pitch_change_all=0, pitch_shift_method='sox', reverb_rm_size=0.15, reverb_wet=0.2,
+                 reverb_dry=0.8, reverb_damping=0.7, meter=None):
+    """
+    Render a cover from the converted vocals and the cached stems, writing only the final file.
+
+    The effects run on the vocals in memory, the stems are pitch shifted once per song (see
+    `get_shifted_stem`) and everything is mixed and encoded in one pass, so a re-mix with other
+    reverb or volume settings only reads the stems and encodes the cover.
+
+    Args:
+        vocals: (np.ndarray) Mono float32 AI vocals, already shifted by `pitch_change_all`
+        vocals_sr: (int) Sample rate of `vocals`
+        pitch_change_all: (int) Pitch change of the backup vocals and instrumentals in semitones
+        pitch_shift_method: (str) 'sox' or 'rubberband'
+        meter: (StageMeter) Records the pitch_shift, effects and mixing stages
+    """
+    shift_keys = []
+    if pitch_change_all != 0:
+        shift_keys = [get_shift_key(path, pitch_change_all, pitch_shift_method) for path in (backup_vocals_path, instrumentals_path)]
+
+    # the shifted stems must outlive the mix, whatever another job adds to the cache meanwhile
+    with stage_cache.leased(shift_keys):
+        if pitch_change_all != 0:
+            with measure(meter, 'pitch_shift') as stage:
+                backup_vocals_path = get_shifted_stem(backup_vocals_path, pitch_change_all, pitch_shift_method, stage)
+                instrumentals_path = get_shifted_stem(instrumentals_path, pitch_change_all, pitch_shift_method, stage)
+
+        with measure(meter, 'effects'):
+            vocals = add_audio_effects(vocals, vocals_sr, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping)
+
+        with measure(meter, 'mixing'):
+            combine_audio(vocals, vocals_sr, [backup_vocals_path, instrumentals_path], output_path, main_gain, backup_gain, inst_gain, output_format)
 
 
 def song_cover_pipeline(song_input, voice_model, pitch_change, keep_files,
                         is_webui=0, main_gain=0, backup_gain=0, inst_gain=0, index_rate=0.5, filter_radius=3,
                         rms_mix_rate=0.25, f0_method='rmvpe', crepe_hop_length=128, protect=0.33, pitch_change_all=0,
                         reverb_rm_size=0.15, reverb_wet=0.2, reverb_dry=0.8, reverb_damping=0.7, output_format='mp3',
-                        progress=gr.Progress()):
+                        progress=gr.Progress(), *, mdx_batch_size=None, pitch_shift_method='sox', report=None):
+    if not song_input or not voice_model:
+        raise_exception('Ensure that the song input field and voice model field is filled.', is_webui)
+
+    return multi_voice_cover_pipeline(song_input, [voice_model], pitch_change, keep_files, is_webui, main_gain, backup_gain, inst_gain,
+                                      index_rate, filter_radius, rms_mix_rate, f0_method, crepe_hop_length, protect, pitch_change_all,
+                                      reverb_rm_size, reverb_wet, reverb_dry, reverb_damping, output_format, progress,
+                                      mdx_batch_size=mdx_batch_size, pitch_shift_method=pitch_shift_method, report=report)[0]
+
+
+def multi_voice_cover_pipeline(song_input, voice_models, pitch_change, keep_files,
+                               is_webui=0, main_gain=0, backup_gain=0, inst_gain=0, index_rate=0.5, filter_radius=3,
+                               rms_mix_rate=0.25, f0_method='rmvpe', crepe_hop_length=128, protect=0.33, pitch_change_all=0,
+                               reverb_rm_size=0.15, reverb_wet=0.2, reverb_dry=0.8, reverb_damping=0.7, output_format='mp3',
+                               progress=None, *, mdx_batch_size=None, pitch_shift_method='sox', report=None):
+    """
+    Render covers of one song with several voice models.
+
+    The song is separated once, its main vocals are loaded once and the f0 curve and HuBERT features
+    are computed once and shared through the stage caches; only the index retrieval, the synthesizer,
+    the effects and the mix run for every voice. The converted vocals of each voice are kept in song_dir,
+    so a re-mix with other effects or volumes only runs `post_process`.
+
+    Every stage is recorded in `report`, which is appended to `job_log_path` when the job ends, whether
+    it succeeds or fails.
+
+    Args:
+        voice_models: (list) Names of folders in the rvc_models directory
+        pitch_change: (int or list) Pitch change of the AI vocals in octaves, for all voices or one per voice
+        pitch_shift_method: (str) 'sox' or 'rubberband', shifts the stems by `pitch_change_all`
+        report: (JobReport) Filled with the stage records of the job, a new one is used if None
+
+    Returns:
+        list: Path of the cover of each voice model, in the order of `voice_models`
+    """
+    report = JobReport() if report is None else report
+    report.params.update(song_input=song_input, voice_models=voice_models, pitch_change=pitch_change, f0_method=f0_method,
+                         index_rate=index_rate, pitch_change_all=pitch_change_all, pitch_shift_method=pitch_shift_method,
+                         output_format=output_format)
+    lease = None
     try:
-        if not song_input or not voice_model:
+        if not song_input or not voice_models:
             raise_exception('Ensure that the song input field and voice model field is filled.', is_webui)
 
+        pitch_changes = pitch_change if isinstance(pitch_change, (list, tuple)) else [pitch_change] * len(voice_models)
+        if len(pitch_changes) != len(voice_models):
+            raise_exception(f'Got {len(pitch_changes)} pitch changes for {len(voice_models)} voice models.', is_webui)
+
         display_progress('[~] Starting AI Cover Generation Pipeline...', 0, is_webui, progress)
 
         with open(os.path.join(mdxnet_models_dir, 'model_data.json')) as infile:
@@ -267,60 +511,61 @@ def song_cover_pipeline(song_input, voice_model, pitch_change, keep_files,
                 raise_exception(error_msg, is_webui)
 
         song_dir = os.path.join(output_dir, song_id)
-
-        if not os.path.exists(song_dir):
-            os.makedirs(song_dir)
-            orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path = preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress)
-
-        else:
-            vocals_path, main_vocals_path = None, None
-            paths = get_audio_paths(song_dir)
-
-            # if any of the audio files aren't available or keep intermediate files, rerun preprocess
-            if any(path is None for path in paths) or keep_files:
-                orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path = preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress)
+        os.makedirs(song_dir, exist_ok=True)
+
+        # keep the stems of this song in the cache until the last cover is mixed, even if other jobs fill it
+        lease = stage_cache.acquire_lease(get_stage_keys(song_id, input_type, mdx_model_params))
+        orig_song_name, stems = preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress, mdx_batch_size, report)
+        instrumentals_path, backup_vocals_path, main_vocals_dereverb_path = stems['instrumentals'], stems['backup_vocals'], stems['main_vocals_dereverb']
+
+        # stems live in the stage cache; copy them next to the cover only when asked to keep them
+        if keep_files:
+            for path in stems.values():
+                shutil.copy(path, song_dir)
+
+        main_vocals = None
+        ai_cover_paths = []
+        for i, (voice_model, voice_pitch_change) in enumerate(zip(voice_models, pitch_changes)):
+            voice_pitch_change = voice_pitch_change * 12 + pitch_change_all
+            ai_vocals_path = os.path.join(song_dir, f'{orig_song_name}_{voice_model}_p{voice_pitch_change}_i{index_rate}_fr{filter_radius}_rms{rms_mix_rate}_pro{protect}_{f0_method}{"" if f0_method != "mangio-crepe" else f"_{crepe_hop_length}"}.wav')
+            ai_cover_path = os.path.join(song_dir, f'{orig_song_name} ({voice_model} Ver).{output_format}')
+            voice_progress, voice_suffix = 0.5 + 0.45 * i / len(voice_models), f' ({voice_model})' if len(voice_models) > 1 else ''
+
+            if os.path.exists(ai_vocals_path):
+                with measure(report, 'decode'):
+                    ai_vocals, ai_vocals_sr = sf.read(ai_vocals_path, dtype='float32')
             else:
-                orig_song_path, instrumentals_path, main_vocals_dereverb_path, backup_vocals_path = paths
-
-        pitch_change = pitch_change * 12 + pitch_change_all
-        ai_vocals_path = os.path.join(song_dir, f'{os.path.splitext(os.path.basename(orig_song_path))[0]}_{voice_model}_p{pitch_change}_i{index_rate}_fr{filter_radius}_rms{rms_mix_rate}_pro{protect}_{f0_method}{"" if f0_method != "mangio-crepe" else f"_{crepe_hop_length}"}.wav')
-        ai_cover_path = os.path.join(song_dir, f'{os.path.splitext(os.path.basename(orig_song_path))[0]} ({voice_model} Ver).{output_format}')
-
-        if not os.path.exists(ai_vocals_path):
-            display_progress('[~] Converting voice using RVC...', 0.5, is_webui, progress)
-            voice_change(voice_model, main_vocals_dereverb_path, ai_vocals_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui)
-
-        display_progress('[~] Applying audio effects to Vocals...', 0.8, is_webui, progress)
-        ai_vocals_mixed_path = add_audio_effects(ai_vocals_path, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping)
-
-        if pitch_change_all != 0:
-            display_progress('[~] Applying overall pitch change', 0.85, is_webui, progress)
-            instrumentals_path = pitch_shift(instrumentals_path, pitch_change_all)
-            backup_vocals_path = pitch_shift(backup_vocals_path, pitch_change_all)
-
-        display_progress('[~] Combining AI Vocals and Instrumentals...', 0.9, is_webui, progress)
-        combine_audio([ai_vocals_mixed_path, backup_vocals_path, instrumentals_path], ai_cover_path, main_gain, backup_gain, inst_gain, output_format)
-
-        if not keep_files:
-            display_progress('[~] Removing intermediate audio files...', 0.95, is_webui, progress)
-            intermediate_files = [vocals_path, main_vocals_path, ai_vocals_mixed_path]
-            if pitch_change_all != 0:
-                intermediate_files += [instrumentals_path, backup_vocals_path]
-            for file in intermediate_files:
-                if file and os.path.exists(file):
-                    os.remove(file)
-
-        return ai_cover_path
+                display_progress(f'[~] Converting voice using RVC{voice_suffix}...', voice_progress, is_webui, progress)
+                if main_vocals is None:
+                    with measure(report, 'decode'):
+                        main_vocals = load_audio(main_vocals_dereverb_path, 16000)
+                ai_vocals, ai_vocals_sr = voice_change(voice_model, main_vocals_dereverb_path, ai_vocals_path, voice_pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui, audio=main_vocals, meter=report)
+                ai_vocals = ai_vocals.astype(np.float32) / 32768
+
+            display_progress(f'[~] Applying audio effects and mixing{voice_suffix}...', voice_progress + 0.3 / len(voice_models), is_webui, progress)
+            post_process(ai_vocals, ai_vocals_sr, backup_vocals_path, instrumentals_path, ai_cover_path, output_format, main_gain,
+                         backup_gain, inst_gain, pitch_change_all, pitch_shift_method, reverb_rm_size, reverb_wet, reverb_dry,
+                         reverb_damping, meter=report)
+            ai_cover_paths.append(ai_cover_path)
+
+        report.finish('ok', ai_cover_paths)
+        return ai_cover_paths
 
     except Exception as e:
+        report.finish('failed', error=str(e))
         raise_exception(str(e), is_webui)
 
+    finally:
+        if lease is not None:
+            stage_cache.release_lease(lease)
+        report.write(job_log_path)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate a AI cover song in the song_output/id directory.', add_help=True)
     parser.add_argument('-i', '--song-input', type=str, required=True, help='Link to a YouTube video or the filepath to a local mp3/wav file to create an AI cover of')
-    parser.add_argument('-dir', '--rvc-dirname', type=str, required=True, help='Name of the folder in the rvc_models directory containing the RVC model file and optional index file to use')
-    parser.add_argument('-p', '--pitch-change', type=int, required=True, help='Change the pitch of AI Vocals only. Generally, use 1 for male to female and -1 for vice-versa. (Octaves)')
+    parser.add_argument('-dir', '--rvc-dirname', type=str, nargs='+', required=True, help='Name of the folder in the rvc_models directory containing the RVC model file and optional index file to use. Give several names to render the song with each voice from a single separation')
+    parser.add_argument('-p', '--pitch-change', type=int, nargs='+', required=True, help='Change the pitch of AI Vocals only. Generally, use 1 for male to female and -1 for vice-versa. (Octaves) Give one value per voice model or one for all of them')
     parser.add_argument('-k', '--keep-files', action=argparse.BooleanOptionalAction, help='Whether to keep all intermediate audio files generated in the song_output/id directory, e.g. Isolated Vocals/Instrumentals')
     parser.add_argument('-ir', '--index-rate', type=float, default=0.5, help='A decimal number e.g. 0.5, used to reduce/resolve the timbre leakage problem. If set to 1, more biased towards the timbre quality of the training dataset')
     parser.add_argument('-fr', '--filter-radius', type=int, default=3, help='A number between 0 and 7. If >=3: apply median filtering to the harvested pitch results. The value represents the filter radius and can reduce breathiness.')
@@ -332,24 +577,38 @@ if __name__ == '__main__':
     parser.add_argument('-bv', '--backup-vol', type=int, default=0, help='Volume change for backup vocals in decibels')
     parser.add_argument('-iv', '--inst-vol', type=int, default=0, help='Volume change for instrumentals in decibels')
     parser.add_argument('-pall', '--pitch-change-all', type=int, default=0, help='Change the pitch/key of vocals and instrumentals. Changing this slightly reduces sound quality')
+    parser.add_argument('-pshift', '--pitch-shift-method', type=str, default='sox', choices=['sox', 'rubberband'], help='Pitch shifter used for --pitch-change-all. rubberband usually keeps more of the timbre')
     parser.add_argument('-rsize', '--reverb-size', type=float, default=0.15, help='Reverb room size between 0 and 1')
     parser.add_argument('-rwet', '--reverb-wetness', type=float, default=0.2, help='Reverb wet level between 0 and 1')
     parser.add_argument('-rdry', '--reverb-dryness', type=float, default=0.8, help='Reverb dry level between 0 and 1')
     parser.add_argument('-rdamp', '--reverb-damping', type=float, default=0.7, help='Reverb damping between 0 and 1')
     parser.add_argument('-oformat', '--output-format', type=str, default='mp3', help='Output format of audio file. mp3 for smaller file size, wav for best quality')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='Number of CPU threads shared by vocal separation, HuBERT and index search. 0 uses all cores')
+    parser.add_argument('-onnx', '--onnx-synthesizer', action='store_true', help='Export the voice model synthesizer to ONNX once and run it with ONNX Runtime, usually faster on CPU')
+    parser.add_argument('-compile', '--compile-synthesizer', action='store_true', help='Compile the voice model synthesizer with torch.compile. The first conversion is slower, later ones are faster')
+    parser.add_argument('-int8', '--int8', action='store_true', help='On CPU, quantize HuBERT to int8 for faster voice conversion. See src/quantization_report.py for its effect on quality')
+    parser.add_argument('-mbs', '--mdx-batch-size', type=int, default=0, help='Number of chunks per MDX ONNX run during vocal separation. 0 picks it automatically from the available memory')
     args = parser.parse_args()
 
-    rvc_dirname = args.rvc_dirname
-    if not os.path.exists(os.path.join(rvc_models_dir, rvc_dirname)):
-        raise Exception(f'The folder {os.path.join(rvc_models_dir, rvc_dirname)} does not exist.')
-
-    cover_path = song_cover_pipeline(args.song_input, rvc_dirname, args.pitch_change, args.keep_files,
-                                     main_gain=args.main_vol, backup_gain=args.backup_vol, inst_gain=args.inst_vol,
-                                     index_rate=args.index_rate, filter_radius=args.filter_radius,
-                                     rms_mix_rate=args.rms_mix_rate, f0_method=args.pitch_detection_algo,
-                                     crepe_hop_length=args.crepe_hop_length, protect=args.protect,
-                                     pitch_change_all=args.pitch_change_all,
-                                     reverb_rm_size=args.reverb_size, reverb_wet=args.reverb_wetness,
-                                     reverb_dry=args.reverb_dryness, reverb_damping=args.reverb_damping,
-                                     output_format=args.output_format)
-    print(f'[+] Cover generated at {cover_path}')
+    for rvc_dirname in args.rvc_dirname:
+        if not os.path.exists(os.path.join(rvc_models_dir, rvc_dirname)):
+            raise Exception(f'The folder {os.path.join(rvc_models_dir, rvc_dirname)} does not exist.')
+
+    if args.threads:
+        model_manager.set_thread_budget(args.threads)
+    model_manager.use_onnx = args.onnx_synthesizer
+    model_manager.use_compile = args.compile_synthesizer
+    model_manager.use_int8 = args.int8
+
+    pitch_change = args.pitch_change if len(args.pitch_change) > 1 else args.pitch_change[0]
+    cover_paths = multi_voice_cover_pipeline(args.song_input, args.rvc_dirname, pitch_change, args.keep_files,
+                                             main_gain=args.main_vol, backup_gain=args.backup_vol, inst_gain=args.inst_vol,
+                                             index_rate=args.index_rate, filter_radius=args.filter_radius,
+                                             rms_mix_rate=args.rms_mix_rate, f0_method=args.pitch_detection_algo,
+                                             crepe_hop_length=args.crepe_hop_length, protect=args.protect,
+                                             pitch_change_all=args.pitch_change_all, pitch_shift_method=args.pitch_shift_method,
+                                             reverb_rm_size=args.reverb_size, reverb_wet=args.reverb_wetness,
+                                             reverb_dry=args.reverb_dryness, reverb_damping=args.reverb_damping,
+                                             output_format=args.output_format, mdx_batch_size=args.mdx_batch_size)
+    for cover_path in cover_paths:
+        print(f'[+] Cover generated at {cover_path}')
@@ -4,6 +4,7 @@ import os
 import queue
 import threading
 import warnings
+from contextlib import suppress
 
 import librosa
 import numpy as np
@@ -12,6 +13,8 @@ import soundfile as sf
 import torch
 from tqdm import tqdm
 
+from device_profile import get_free_memory
+
 warnings.filterwarnings("ignore")
 stem_naming = {'Vocals': 'Instrumental', 'Other': 'Instruments', 'Instrumental': 'Vocals', 'Drums': 'Drumless', 'Bass': 'Bassless'}
 
@@ -54,6 +57,93 @@ class MDXModel:
         return x.reshape([-1, 2, self.chunk_size])
 
 
+class OrtSessionPool:
+    """
+    Process-wide pool of warmed up ONNX Runtime sessions, keyed by model path, providers and session options.
+
+    ONNX Runtime sessions are safe to run from several threads, so every job shares the same session.
+    The graph optimized by ONNX Runtime is saved next to the model (in an `optimized` folder) and is
+    loaded directly on later process starts, which skips graph optimization.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        # applied to every session unless overridden per call, e.g. the thread budget of the process
+        self.default_session_options = {}
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    @staticmethod
+    def make_session_options(session_options=None, optimization_level=ort.GraphOptimizationLevel.ORT_ENABLE_ALL):
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = optimization_level
+        for name, value in (session_options or {}).items():
+            setattr(sess_options, name, value)
+        return sess_options
+
+    def get_optimized_path(self, model_path, key):
+        cache_dir = self.cache_dir or os.path.join(os.path.dirname(os.path.abspath(model_path)), 'optimized')
+        key_hash = hashlib.md5(repr((MDX.get_hash(model_path), key[1:])).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(model_path))[0]}.{key_hash}.onnx')
+
+    def _create(self, model_path, providers, session_options, key):
+        optimized_path = self.get_optimized_path(model_path, key)
+        if not os.path.exists(optimized_path):
+            # optimize once and save the graph; written to a temporary file first as other workers may race on it
+            os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+            tmp_path = f'{optimized_path}.{os.getpid()}.tmp'
+            sess_options = self.make_session_options(session_options, ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED)
+            sess_options.optimized_model_filepath = tmp_path
+            try:
+                ort.InferenceSession(model_path, sess_options, providers=list(providers))
+                os.replace(tmp_path, optimized_path)
+            except Exception:
+                warnings.warn(f'Could not save the optimized graph of {model_path}')
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp_path)
+
+        if os.path.exists(optimized_path):
+            # the saved graph already has the basic and extended optimizations applied; on CPU the
+            # layout optimizations are hardware specific and are never saved, so they still run here
+            level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL if providers[0] == 'CPUExecutionProvider' else ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                return ort.InferenceSession(optimized_path, self.make_session_options(session_options, level), providers=list(providers))
+            except Exception:
+                # another worker may have removed the stale graph already
+                with suppress(FileNotFoundError):
+                    os.remove(optimized_path)
+
+        return ort.InferenceSession(model_path, self.make_session_options(session_options), providers=list(providers))
+
+    def get(self, model_path, providers, session_options=None, warmup_shape=None):
+        """
+        Get a shared session for the model, creating and warming it up on first use
+
+        Args:
+            model_path: (str) Path to the ONNX model
+            providers: (list) ONNX Runtime execution providers
+            session_options: (dict) Attributes set on ort.SessionOptions, e.g. intra_op_num_threads
+            warmup_shape: (tuple) Shape of a random input run once after the session is created
+
+        Returns:
+            ort.InferenceSession: Session shared by every caller with the same key
+        """
+        session_options = {**self.default_session_options, **(session_options or {})}
+        key = (os.path.abspath(model_path), tuple(providers), tuple(sorted(session_options.items())))
+        with self._lock:
+            if key not in self._sessions:
+                session = self._create(model_path, tuple(providers), session_options, key)
+                if warmup_shape is not None:
+                    # Preload the model for faster performance
+                    session.run(None, {session.get_inputs()[0].name: np.random.rand(*warmup_shape).astype(np.float32)})
+                self._sessions[key] = session
+            return self._sessions[key]
+
+
+session_pool = OrtSessionPool()
+
+
 class MDX:
     DEFAULT_SR = 44100
     # Unit: seconds
@@ -62,7 +152,12 @@ class MDX:
 
     DEFAULT_PROCESSOR = 0
 
-    def __init__(self, model_path: str, params: MDXModel, processor=DEFAULT_PROCESSOR):
+    # Upper bound for the automatically chosen number of chunks per ONNX run
+    MAX_BATCH_SIZE = 16
+    # Rough multiple of the spectrogram size needed per chunk (STFT buffers and ONNX activations)
+    BATCH_MEMORY_FACTOR = 32
+
+    def __init__(self, model_path: str, params: MDXModel, processor=DEFAULT_PROCESSOR, ort_session=None):
 
         # Set the device and the provider (CPU or CUDA)
         self.device = torch.device(f'cuda:{processor}') if processor >= 0 else torch.device('cpu')
@@ -70,14 +165,37 @@ class MDX:
 
         self.model = params
 
-        # Load the ONNX model using ONNX Runtime
-        self.ort = ort.InferenceSession(model_path, providers=self.provider)
-        # Preload the model for faster performance
-        self.ort.run(None, {'input': torch.rand(1, 4, params.dim_f, params.dim_t).numpy()})
-        self.process = lambda spec: self.ort.run(None, {'input': spec.cpu().numpy()})[0]
+        # Load the ONNX model using ONNX Runtime, reusing the warmed up session of earlier runs
+        self.ort = ort_session if ort_session is not None else session_pool.get(model_path, self.provider, warmup_shape=(1, 4, params.dim_f, params.dim_t))
+        # Models exported with a fixed batch dimension are run in slices of that size
+        batch_dim = self.ort.get_inputs()[0].shape[0]
+        self.fixed_batch = batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
 
         self.prog = None
 
+    def process(self, spec):
+        spec = spec.cpu().numpy()
+        if self.fixed_batch is None or spec.shape[0] == self.fixed_batch:
+            return self.ort.run(None, {'input': spec})[0]
+        return np.concatenate([self.ort.run(None, {'input': spec[i:i + self.fixed_batch]})[0] for i in range(0, spec.shape[0], self.fixed_batch)])
+
+    def get_batch_size(self, mt_threads=1, denoise=False):
+        """
+        Pick how many chunks to stack per STFT / ONNX run / ISTFT from the memory currently available
+
+        Args:
+            mt_threads: (int) Number of threads processing chunks at the same time
+            denoise: (bool) Whether each chunk is run together with its negation
+
+        Returns:
+            int: Number of chunks per batch
+        """
+        free_bytes = get_free_memory(self.device)
+        spec_bytes = 4 * self.model.n_bins * self.model.dim_t * 4
+        chunk_bytes = spec_bytes * self.BATCH_MEMORY_FACTOR * (2 if denoise else 1) * mt_threads
+        # leave most of the memory to the rest of the pipeline
+        return int(max(1, min(self.MAX_BATCH_SIZE, free_bytes // 4 // chunk_bytes)))
+
     @staticmethod
     def get_hash(model_path):
         try:
@@ -170,7 +288,7 @@ class MDX:
 
         return mix_waves, pad, trim
 
-    def _process_wave(self, mix_waves, trim, pad, q: queue.Queue, _id: int):
+    def _process_wave(self, mix_waves, trim, pad, q: queue.Queue, _id: int, denoise=False, batch_size=1):
         """
         Process each wave segment in a multi-threaded environment
 
@@ -180,35 +298,47 @@ class MDX:
             pad: (int) Number of samples padded during padding
             q: (queue.Queue) Queue to hold the processed wave segments
             _id: (int) Identifier of the processed wave segment
+            denoise: (bool) If True, run each segment together with its negation in one batch and
+                return process(x) - process(-x)
+            batch_size: (int) Number of segments stacked per STFT / ONNX run / ISTFT
 
         Returns:
             numpy array: Processed wave segment
         """
-        mix_waves = mix_waves.split(1)
+        mix_waves = mix_waves.split(batch_size)
         with torch.no_grad():
             pw = []
             for mix_wave in mix_waves:
-                self.prog.update()
+                n_chunks = mix_wave.shape[0]
+                if denoise:
+                    mix_wave = torch.cat([mix_wave, -mix_wave])
                 spec = self.model.stft(mix_wave)
                 processed_spec = torch.tensor(self.process(spec))
                 processed_wav = self.model.istft(processed_spec.to(self.device))
+                if denoise:
+                    processed_wav = processed_wav[:n_chunks] - processed_wav[n_chunks:]
+                self.prog.update(n_chunks)
                 processed_wav = processed_wav[:, :, trim:-trim].transpose(0, 1).reshape(2, -1).cpu().numpy()
                 pw.append(processed_wav)
         processed_signal = np.concatenate(pw, axis=-1)[:, :-pad]
         q.put({_id: processed_signal})
         return processed_signal
 
-    def process_wave(self, wave: np.array, mt_threads=1):
+    def process_wave(self, wave: np.array, mt_threads=1, denoise=False, batch_size=None):
         """
         Process the wave array in a multi-threaded environment
 
         Args:
             wave: (np.array) Wave array to be processed
             mt_threads: (int) Number of threads to be used for processing
+            denoise: (bool) If True, returns process(wave) - process(-wave), computed in a single batched pass
+            batch_size: (int) Number of chunks per ONNX run. If None or 0, sized from the available memory
 
         Returns:
             numpy array: Processed wave array
         """
+        if not batch_size:
+            batch_size = self.get_batch_size(mt_threads, denoise)
         self.prog = tqdm(total=0)
         chunk = wave.shape[-1] // mt_threads
         waves = self.segment(wave, False, chunk)
@@ -219,7 +349,7 @@ class MDX:
         for c, batch in enumerate(waves):
             mix_waves, pad, trim = self.pad_wave(batch)
             self.prog.total = len(mix_waves) * mt_threads
-            thread = threading.Thread(target=self._process_wave, args=(mix_waves, trim, pad, q, c))
+            thread = threading.Thread(target=self._process_wave, args=(mix_waves, trim, pad, q, c, denoise, batch_size))
             thread.start()
             threads.append(thread)
         for thread in threads:
@@ -235,14 +365,50 @@ class MDX:
         return self.segment(processed_batches, True, chunk)
 
 
-def run_mdx(model_params, output_dir, model_path, filename, exclude_main=False, exclude_inversion=False, suffix=None, invert_suffix=None, denoise=False, keep_orig=True, m_threads=2):
-    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
-
-    device_properties = torch.cuda.get_device_properties(device)
-    vram_gb = device_properties.total_memory / 1024**3
-    m_threads = 1 if vram_gb < 8 else 2
+def get_stem_names(stem_name, input_name, suffix=None, invert_suffix=None):
+    """
+    Names of the main and inverted stems produced from an input, e.g. "song_Vocals" and "song_Instrumental"
+
+    Args:
+        stem_name: (str) Primary stem of the MDX model
+        input_name: (str) Input file name without extension
+        suffix: (str) Overrides the primary stem name
+        invert_suffix: (str) Overrides the inverted stem name
+
+    Returns:
+        tuple: (main_name, invert_name)
+    """
+    stem_name = stem_name if suffix is None else suffix
+    diff_stem_name = stem_naming.get(stem_name) if invert_suffix is None else invert_suffix
+    diff_stem_name = f"{stem_name}_diff" if diff_stem_name is None else diff_stem_name
+    return f"{input_name}_{stem_name}", f"{input_name}_{diff_stem_name}"
+
+
+def mdx_separate(model_params, model_path, wave, exclude_main=False, exclude_inversion=False, denoise=False, m_threads=2, ort_session=None, model_hash=None, batch_size=None):
+    """
+    Separate an in-memory wave with an MDX model
+
+    Args:
+        model_params: (dict) Contents of model_data.json
+        model_path: (str) Path to the MDX ONNX model
+        wave: (np.array) Stereo wave at 44.1 kHz with shape (2, n_samples). It is not modified.
+        exclude_main: (bool) If True, the primary stem is not returned
+        exclude_inversion: (bool) If True, the inverted stem is not returned
+        denoise: (bool) Average the outputs of wave and -wave to cancel model noise
+
+    Returns:
+        tuple: (main_wave, invert_wave), each with shape (2, n_samples) or None if excluded
+    """
+    if torch.cuda.is_available():
+        device = torch.device('cuda:0')
+        vram_gb = torch.cuda.get_device_properties(device).total_memory / 1024**3
+        m_threads = 1 if vram_gb < 8 else 2
+    else:
+        # on CPU the ONNX Runtime and torch thread pools already use every core of the thread budget
+        device = torch.device('cpu')
+        m_threads = 1
 
-    model_hash = MDX.get_hash(model_path)
+    model_hash = MDX.get_hash(model_path) if model_hash is None else model_hash
     mp = model_params.get(model_hash)
     model = MDXModel(
         device,
@@ -253,35 +419,45 @@ def run_mdx(model_params, output_dir, model_path, filename, exclude_main=False,
         compensation=mp["compensate"]
     )
 
-    mdx_sess = MDX(model_path, model)
-    wave, sr = librosa.load(filename, mono=False, sr=44100)
+    mdx_sess = MDX(model_path, model, processor=device.index if device.type == 'cuda' else -1, ort_session=ort_session)
     # normalizing input wave gives better output
     peak = max(np.max(wave), abs(np.min(wave)))
-    wave /= peak
+    wave = wave / peak
     if denoise:
-        wave_processed = -(mdx_sess.process_wave(-wave, m_threads)) + (mdx_sess.process_wave(wave, m_threads))
+        # process(wave) and process(-wave) share one ONNX batch instead of two full passes
+        wave_processed = mdx_sess.process_wave(wave, m_threads, denoise=True, batch_size=batch_size)
         wave_processed *= 0.5
     else:
-        wave_processed = mdx_sess.process_wave(wave, m_threads)
+        wave_processed = mdx_sess.process_wave(wave, m_threads, batch_size=batch_size)
     # return to previous peak
     wave_processed *= peak
-    stem_name = model.stem_name if suffix is None else suffix
+
+    main_wave = None if exclude_main else wave_processed
+    invert_wave = None if exclude_inversion else (-wave_processed * model.compensation) + wave
+
+    del mdx_sess
+    return main_wave, invert_wave
+
+
+def run_mdx(model_params, output_dir, model_path, filename, exclude_main=False, exclude_inversion=False, suffix=None, invert_suffix=None, denoise=False, keep_orig=True, m_threads=2, ort_session=None, model_hash=None, batch_size=None):
+    model_hash = MDX.get_hash(model_path) if model_hash is None else model_hash
+    wave, sr = librosa.load(filename, mono=False, sr=44100)
+    main_wave, invert_wave = mdx_separate(model_params, model_path, wave, exclude_main, exclude_inversion, denoise, m_threads, ort_session, model_hash, batch_size)
+    main_name, invert_name = get_stem_names(model_params[model_hash]["primary_stem"], os.path.basename(os.path.splitext(filename)[0]), suffix, invert_suffix)
 
     main_filepath = None
-    if not exclude_main:
-        main_filepath = os.path.join(output_dir, f"{os.path.basename(os.path.splitext(filename)[0])}_{stem_name}.wav")
-        sf.write(main_filepath, wave_processed.T, sr)
+    if main_wave is not None:
+        main_filepath = os.path.join(output_dir, f"{main_name}.wav")
+        sf.write(main_filepath, main_wave.T, sr)
 
     invert_filepath = None
-    if not exclude_inversion:
-        diff_stem_name = stem_naming.get(stem_name) if invert_suffix is None else invert_suffix
-        stem_name = f"{stem_name}_diff" if diff_stem_name is None else diff_stem_name
-        invert_filepath = os.path.join(output_dir, f"{os.path.basename(os.path.splitext(filename)[0])}_{stem_name}.wav")
-        sf.write(invert_filepath, (-wave_processed.T * model.compensation) + wave.T, sr)
+    if invert_wave is not None:
+        invert_filepath = os.path.join(output_dir, f"{invert_name}.wav")
+        sf.write(invert_filepath, invert_wave.T, sr)
 
     if not keep_orig:
         os.remove(filename)
 
-    del mdx_sess, wave_processed, wave
+    del main_wave, invert_wave, wave
     gc.collect()
     return main_filepath, invert_filepath
@@ -0,0 +1,139 @@
+import os
+import threading
+from collections import OrderedDict
+
+import faiss
+import torch
+
+from mdx import MDX, session_pool
+from rmvpe import RMVPE
+from rvc import Config, get_vc, load_hubert, quantize_dynamic
+from rvc_onnx import OnnxSynthesizer
+from vc_infer_pipeline import VC
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+mdxnet_models_dir = os.path.join(BASE_DIR, 'mdxnet_models')
+rvc_models_dir = os.path.join(BASE_DIR, 'rvc_models')
+
+MDX_MODEL_NAMES = ['UVR-MDX-NET-Voc_FT.onnx', 'UVR_MDXNET_KARA_2.onnx', 'Reverb_HQ_By_FoxJoy.onnx']
+MAX_VOICE_MODELS = 3
+
+
+class ModelManager:
+    """
+    Process-wide holder for the models every cover needs (HuBERT, RMVPE and the MDX ONNX sessions).
+
+    Each model is loaded once on first use and the same reference is handed out afterwards, so
+    consecutive or concurrent jobs do not pay the checkpoint loading cost again. Loading is guarded
+    by a lock; the returned models are only used for inference and are safe to share between threads.
+    Voice models are kept in a small least recently used cache bounded by `max_voice_models`.
+    """
+
+    def __init__(self, max_voice_models=MAX_VOICE_MODELS, use_onnx=False, use_compile=False, use_int8=False):
+        self.max_voice_models = max_voice_models
+        # run the voice model synthesizers with ONNX Runtime instead of torch
+        self.use_onnx = use_onnx
+        # torch.compile the voice model synthesizers, see rvc.build_inference_model
+        self.use_compile = use_compile
+        # int8 dynamic quantization of HuBERT when running on CPU, see rvc.quantize_dynamic
+        self.use_int8 = use_int8
+        self._lock = threading.RLock()
+        self._configs = {}
+        self._huberts = {}
+        self._rmvpes = {}
+        self._mdx_hashes = {}
+        self._voice_models = OrderedDict()
+        self.threads = None
+
+    def set_thread_budget(self, threads):
+        """
+        Limit the number of CPU threads used by MDX (ONNX Runtime and torch STFT), HuBERT, RMVPE and faiss.
+
+        Call it before any model is loaded, as sessions created earlier keep their thread pools.
+        """
+        self.threads = threads
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work has started
+            pass
+        faiss.omp_set_num_threads(threads)
+        session_pool.default_session_options = {'intra_op_num_threads': threads, 'inter_op_num_threads': 1}
+
+    def get_config(self, device='cuda:0', is_half=True):
+        key = (device, is_half)
+        with self._lock:
+            if key not in self._configs:
+                self._configs[key] = Config(device, is_half)
+            return self._configs[key]
+
+    def get_hubert(self, device, is_half):
+        int8 = self.use_int8 and str(device) == 'cpu' and not is_half
+        key = (str(device), is_half, int8)
+        with self._lock:
+            if key not in self._huberts:
+                hubert_path = os.path.join(rvc_models_dir, 'hubert_base.pt')
+                hubert = load_hubert(device, is_half, hubert_path)
+                if int8:
+                    hubert = quantize_dynamic(hubert)
+                # identifies the checkpoint (and its precision) in the HuBERT feature cache keys
+                hubert.checkpoint_hash = MDX.get_hash(hubert_path) + ('-int8' if int8 else '')
+                self._huberts[key] = hubert
+            return self._huberts[key]
+
+    def get_rmvpe(self, device, is_half):
+        key = (str(device), is_half)
+        with self._lock:
+            if key not in self._rmvpes:
+                self._rmvpes[key] = RMVPE(os.path.join(rvc_models_dir, 'rmvpe.pt'), is_half=is_half, device=device)
+            return self._rmvpes[key]
+
+    def get_mdx_hash(self, model_path):
+        with self._lock:
+            if model_path not in self._mdx_hashes:
+                self._mdx_hashes[model_path] = MDX.get_hash(model_path)
+            return self._mdx_hashes[model_path]
+
+    def get_mdx_session(self, model_path, model_params):
+        providers = ['CUDAExecutionProvider'] if torch.cuda.is_available() else ['CPUExecutionProvider']
+        mp = model_params.get(self.get_mdx_hash(model_path))
+        return session_pool.get(model_path, providers, warmup_shape=(1, 4, mp['mdx_dim_f_set'], 2 ** mp['mdx_dim_t_set']))
+
+    def get_voice_model(self, voice_model, model_path, config):
+        """Returns (cpt, version, net_g, tgt_sr, vc) for the voice model, as returned by `get_vc`."""
+        key = (voice_model, model_path, config.device, config.is_half, self.use_onnx, self.use_compile)
+        with self._lock:
+            if key in self._voice_models:
+                self._voice_models.move_to_end(key)
+                return self._voice_models[key]
+
+            # evict before loading so at most max_voice_models are resident at any time
+            while self._voice_models and len(self._voice_models) >= self.max_voice_models:
+                self._voice_models.popitem(last=False)
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+            voice = get_vc(config.device, config.is_half, config, model_path, self.use_onnx, self.use_compile)
+            cpt, version, net_g, tgt_sr, vc = voice
+            if isinstance(net_g, OnnxSynthesizer):
+                # the calibration only measures torch allocations, not the ONNX Runtime arena
+                if config.profile.get('calibrated'):
+                    voice = (cpt, version, net_g, tgt_sr, VC(tgt_sr, config.uncalibrated()))
+            elif config.needs_calibration:
+                # first voice model loaded on an uncalibrated device, measure it to size the segments
+                config.calibrate(vc, self.get_hubert(config.device, config.is_half), net_g, version, cpt.get('f0', 1))
+                voice = (cpt, version, net_g, tgt_sr, VC(tgt_sr, config))
+            self._voice_models[key] = voice
+            return self._voice_models[key]
+
+    def preload(self, mdx_model_params, device='cuda:0', is_half=True):
+        config = self.get_config(device, is_half)
+        self.get_hubert(config.device, config.is_half)
+        self.get_rmvpe(config.device, config.is_half)
+        for model_name in MDX_MODEL_NAMES:
+            self.get_mdx_session(os.path.join(mdxnet_models_dir, model_name), mdx_model_params)
+
+
+model_manager = ModelManager()
@@ -0,0 +1,61 @@
+import argparse
+import time
+
+import librosa
+import numpy as np
+
+from main import get_rvc_model
+from model_manager import model_manager
+from my_utils import load_audio
+
+
+def mel_distance(reference, audio, sr, n_mels=80):
+    """Mean absolute difference in dB between the log-mel spectrograms of two signals."""
+    length = min(reference.shape[0], audio.shape[0])
+    mels = [
+        librosa.power_to_db(librosa.feature.melspectrogram(y=y[:length].astype(np.float32), sr=sr, n_mels=n_mels), ref=1.0)
+        for y in (reference, audio)
+    ]
+    return float(np.abs(mels[0] - mels[1]).mean())
+
+
+def convert(audio, hubert_model, voice, pitch_change, f0_method, index_path, index_rate):
+    cpt, version, net_g, tgt_sr, vc = voice
+    start_time = time.time()
+    audio_opt = vc.pipeline(hubert_model, net_g, 0, audio, '', [0, 0, 0], pitch_change, f0_method, index_path, index_rate,
+                            cpt.get('f0', 1), 3, tgt_sr, 0, 1, version, 0.33, 128)
+    return audio_opt.astype(np.float32) / 32768, time.time() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare CPU voice conversion with an int8 quantized HuBERT against float32.', add_help=True)
+    parser.add_argument('-i', '--input', type=str, required=True, help='Vocals to convert, e.g. a main vocals stem from song_output')
+    parser.add_argument('-dir', '--rvc-dirname', type=str, required=True, help='Name of the folder in the rvc_models directory containing the RVC model file and optional index file to use')
+    parser.add_argument('-p', '--pitch-change', type=int, default=0, help='Change the pitch of the voice in semitones')
+    parser.add_argument('-palgo', '--pitch-detection-algo', type=str, default='rmvpe', help='Pitch detection algorithm')
+    parser.add_argument('-ir', '--index-rate', type=float, default=0.5, help='Ratio of the retrieved features used, between 0 and 1')
+    args = parser.parse_args()
+
+    rvc_model_path, rvc_index_path = get_rvc_model(args.rvc_dirname, False)
+    config = model_manager.get_config('cuda:0', True)
+    if config.device != 'cpu':
+        raise SystemExit('int8 quantization is only used on CPU, run this report on a CPU-only host.')
+    voice = model_manager.get_voice_model(args.rvc_dirname, rvc_model_path, config)
+    audio = load_audio(args.input, 16000)
+    convert_args = (voice, args.pitch_change, args.pitch_detection_algo, rvc_index_path, args.index_rate)
+
+    hubert_fp32 = model_manager.get_hubert(config.device, config.is_half)
+    model_manager.use_int8 = True
+    hubert_int8 = model_manager.get_hubert(config.device, config.is_half)
+
+    # two float32 runs give the noise floor: the synthesizer samples random noise on every run
+    fp32_reference, fp32_time = convert(audio, hubert_fp32, *convert_args)
+    fp32_audio, _ = convert(audio, hubert_fp32, *convert_args)
+    int8_audio, int8_time = convert(audio, hubert_int8, *convert_args)
+
+    tgt_sr = voice[3]
+    duration = audio.shape[0] / 16000
+    print(f'[+] float32: {fp32_time:.1f}s ({duration / fp32_time:.2f}x real time)')
+    print(f'[+] int8:    {int8_time:.1f}s ({duration / int8_time:.2f}x real time), {fp32_time / int8_time:.2f}x faster')
+    print(f'[+] Mel distance float32 vs float32 (noise floor): {mel_distance(fp32_reference, fp32_audio, tgt_sr):.3f} dB')
+    print(f'[+] Mel distance float32 vs int8:                 {mel_distance(fp32_reference, int8_audio, tgt_sr):.3f} dB')
@@ -383,27 +383,18 @@ class RMVPE:
         return f0
 
     def to_local_average_cents(self, salience, thred=0.05):
-        # t0 = ttime()
+        n_frames, n_bins = salience.shape
         center = np.argmax(salience, axis=1)  # 帧长#index
-        salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
-        # t1 = ttime()
-        center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx] : ends[idx]])
-        # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
+        # 9 bins around the peak of every frame, gathered at once instead of frame by frame.
+        # Indices are in the 4-bin zero padded space of cents_mapping; bins outside the salience are 0.
+        idx = center[:, None] + np.arange(9)  # 帧长，9
+        todo_salience = np.take_along_axis(salience, np.clip(idx - 4, 0, n_bins - 1), axis=1)  # 帧长，9
+        todo_salience[(idx < 4) | (idx >= n_bins + 4)] = 0
+        todo_cents_mapping = self.cents_mapping[idx]  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
-        # t3 = ttime()
-        maxx = np.max(salience, axis=1)  # 帧长
+        # the peak is the value at the argmax; the zero padding of the previous implementation floors it at 0
+        maxx = np.maximum(salience[np.arange(n_frames), center], 0)  # 帧长
         devided[maxx <= thred] = 0
-        # t4 = ttime()
-        # print("decode:%s\t%s\t%s\t%s" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         return devided
@@ -1,3 +1,5 @@
+import copy
+import platform
 from multiprocessing import cpu_count
 from pathlib import Path
 
@@ -5,6 +7,17 @@ import torch
 from fairseq import checkpoint_utils
 from scipy.io import wavfile
 
+from device_profile import (
+    MEMORY_HEADROOM,
+    MODEL_MEMORY,
+    calibrate,
+    get_default_profile,
+    get_free_memory,
+    get_profile_key,
+    load_profile,
+    plan_segments,
+    save_profile,
+)
 from infer_pack.models import (
     SynthesizerTrnMs256NSFsid,
     SynthesizerTrnMs256NSFsid_nono,
@@ -12,6 +25,7 @@ from infer_pack.models import (
     SynthesizerTrnMs768NSFsid_nono,
 )
 from my_utils import load_audio
+from rvc_onnx import load_onnx_synthesizer
 from vc_infer_pipeline import VC
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -24,6 +38,9 @@ class Config:
         self.n_cpu = 0
         self.gpu_name = None
         self.gpu_mem = None
+        self.vc_batch_size = 1
+        self.profile_key = None
+        self.profile = None
         self.x_pad, self.x_query, self.x_center, self.x_max = self.device_config()
 
     def device_config(self) -> tuple:
@@ -39,17 +56,6 @@ class Config:
             ):
                 print("16 series/10 series P40 forced single precision")
                 self.is_half = False
-                for config_file in ["32k.json", "40k.json", "48k.json"]:
-                    with open(BASE_DIR / "src" / "configs" / config_file, "r") as f:
-                        strr = f.read().replace("true", "false")
-                    with open(BASE_DIR / "src" / "configs" / config_file, "w") as f:
-                        f.write(strr)
-                with open(BASE_DIR / "src" / "trainset_preprocess_pipeline_print.py", "r") as f:
-                    strr = f.read().replace("3.7", "3.0")
-                with open(BASE_DIR / "src" / "trainset_preprocess_pipeline_print.py", "w") as f:
-                    f.write(strr)
-            else:
-                self.gpu_name = None
             self.gpu_mem = int(
                 torch.cuda.get_device_properties(i_device).total_memory
                 / 1024
@@ -57,42 +63,65 @@ class Config:
                 / 1024
                 + 0.4
             )
-            if self.gpu_mem <= 4:
-                with open(BASE_DIR / "src" / "trainset_preprocess_pipeline_print.py", "r") as f:
-                    strr = f.read().replace("3.7", "3.0")
-                with open(BASE_DIR / "src" / "trainset_preprocess_pipeline_print.py", "w") as f:
-                    f.write(strr)
         elif torch.backends.mps.is_available():
             print("No supported N-card found, use MPS for inference")
             self.device = "mps"
         else:
             print("No supported N-card found, use CPU for inference")
             self.device = "cpu"
-            self.is_half = True
+            # most x86 CPUs have no fast float16 kernels, use int8 quantization instead (see quantize_dynamic)
+            self.is_half = False
 
         if self.n_cpu == 0:
             self.n_cpu = cpu_count()
 
-        if self.is_half:
-            # 6G memory config
-            x_pad = 3
-            x_query = 10
-            x_center = 60
-            x_max = 65
-        else:
-            # 5G memory config
-            x_pad = 1
-            x_query = 6
-            x_center = 38
-            x_max = 41
-
-        if self.gpu_mem != None and self.gpu_mem <= 4:
-            x_pad = 1
-            x_query = 5
-            x_center = 30
-            x_max = 32
-
-        return x_pad, x_query, x_center, x_max
+        self.profile_key = get_profile_key(self.device, self.gpu_name or platform.processor(), self.is_half)
+        self.profile = load_profile(self.profile_key) or get_default_profile(self.is_half)
+        return self.apply_profile()
+
+    @property
+    def needs_calibration(self):
+        return self.device.startswith("cuda") and not self.profile.get("calibrated")
+
+    def apply_profile(self, models_loaded=False) -> tuple:
+        """
+        Size the segments from the free memory of the device and the memory cost of the profile.
+
+        Args:
+            models_loaded: (bool) True if the free memory already excludes the models, as after a calibration
+
+        Returns:
+            tuple: x_pad, x_query, x_center and x_max in seconds, also set on the config with vc_batch_size
+        """
+        memory_budget = get_free_memory(self.device) * MEMORY_HEADROOM - self.profile["memory_overhead"]
+        if not models_loaded:
+            memory_budget -= MODEL_MEMORY
+        # on CPU the convolutions already use every core, so batching only adds padding
+        plan = plan_segments(memory_budget, self.profile["memory_per_second"], self.device.startswith("cuda"))
+        self.x_pad, self.x_query, self.x_center, self.x_max = plan["x_pad"], plan["x_query"], plan["x_center"], plan["x_max"]
+        self.vc_batch_size = plan["vc_batch_size"]
+        return self.x_pad, self.x_query, self.x_center, self.x_max
+
+    def uncalibrated(self):
+        """
+        Copy of the config with segments sized from the default profile, for synthesizers the calibration
+        cannot measure, e.g. ONNX Runtime, whose memory arena is not a torch allocation.
+        """
+        config = copy.copy(self)
+        config.profile = get_default_profile(self.is_half)
+        config.apply_profile()
+        return config
+
+    def calibrate(self, vc, hubert_model, net_g, version, if_f0):
+        """
+        Measure the memory cost of a conversion with loaded models, store it in the profile of this host
+        and resize the segments. Pipelines built before the calibration keep their segment sizes.
+        """
+        print("[~] Calibrating segment sizes for this device...")
+        self.profile = {**calibrate(vc, hubert_model, net_g, version, if_f0), "calibrated": True}
+        save_profile(self.profile_key, self.profile)
+        self.apply_profile(models_loaded=True)
+        print(f"[+] Segments of {self.x_center}s, batches of {self.vc_batch_size}")
 
 
 def load_hubert(device, is_half, model_path):
@@ -109,7 +138,40 @@ def load_hubert(device, is_half, model_path):
     return hubert
 
 
-def get_vc(device, is_half, config, model_path):
+def build_inference_model(net_g, use_compile=False):
+    """
+    Prepare a loaded synthesizer for inference.
+
+    Weight norm is folded into the convolution weights of the decoder and the flow, which otherwise
+    recompute them from their g and v parameters on every forward pass. With `use_compile`, the decoder and
+    the flow are also compiled with torch.compile for any number of frames; the generated kernels are
+    kept in the on-disk cache of torch inductor, so later loads of the model skip most of the compilation.
+    """
+    net_g.dec.remove_weight_norm()
+    net_g.flow.remove_weight_norm()
+    if use_compile and hasattr(torch, "compile"):
+        net_g.dec = torch.compile(net_g.dec, dynamic=True)
+        net_g.flow = torch.compile(net_g.flow, dynamic=True)
+    return net_g
+
+
+def quantize_dynamic(model):
+    """
+    Quantize the linear layers of a model to int8 with dynamic activation scales, for CPU inference.
+
+    Linear layers inside attention modules are kept in float32, since attention implementations such as
+    fairseq's read the projection weights directly instead of calling the layers. For HuBERT this covers
+    the feed-forward layers of the transformer, which hold most of its compute.
+    """
+    attention_names = [name for name, module in model.named_modules() if 'Attention' in type(module).__name__]
+    linear_names = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not any(name.startswith(f'{prefix}.') for prefix in attention_names)
+    }
+    return torch.quantization.quantize_dynamic(model, linear_names, dtype=torch.qint8)
+
+
+def get_vc(device, is_half, config, model_path, use_onnx=False, use_compile=False):
     cpt = torch.load(model_path, map_location='cpu')
     if "config" not in cpt or "weight" not in cpt:
         raise ValueError(f'Incorrect format for {model_path}. Use a voice model trained using RVC v2 instead.')
@@ -132,20 +194,26 @@ def get_vc(device, is_half, config, model_path):
 
     del net_g.enc_q
     print(net_g.load_state_dict(cpt["weight"], strict=False))
-    net_g.eval().to(device)
+    net_g = build_inference_model(net_g.eval(), use_compile and not use_onnx)
+    net_g.to(device)
 
     if is_half:
         net_g = net_g.half()
     else:
         net_g = net_g.float()
 
+    if use_onnx:
+        providers = ['CUDAExecutionProvider'] if str(device).startswith('cuda') else ['CPUExecutionProvider']
+        net_g = load_onnx_synthesizer(cpt, model_path, providers) or net_g
+
     vc = VC(tgt_sr, config)
     return cpt, version, net_g, tgt_sr, vc
 
 
-def rvc_infer(index_path, index_rate, input_path, output_path, pitch_change, f0_method, cpt, version, net_g, filter_radius, tgt_sr, rms_mix_rate, protect, crepe_hop_length, vc, hubert_model):
-    audio = load_audio(input_path, 16000)
+def rvc_infer(index_path, index_rate, input_path, output_path, pitch_change, f0_method, cpt, version, net_g, filter_radius, tgt_sr, rms_mix_rate, protect, crepe_hop_length, vc, hubert_model, cache=None, feature_cache=None, audio=None, meter=None):
+    audio = load_audio(input_path, 16000) if audio is None else audio
     times = [0, 0, 0]
     if_f0 = cpt.get('f0', 1)
-    audio_opt = vc.pipeline(hubert_model, net_g, 0, audio, input_path, times, pitch_change, f0_method, index_path, index_rate, if_f0, filter_radius, tgt_sr, 0, rms_mix_rate, version, protect, crepe_hop_length)
+    audio_opt = vc.pipeline(hubert_model, net_g, 0, audio, input_path, times, pitch_change, f0_method, index_path, index_rate, if_f0, filter_radius, tgt_sr, 0, rms_mix_rate, version, protect, crepe_hop_length, cache=cache, feature_cache=feature_cache, meter=meter)
     wavfile.write(output_path, tgt_sr, audio_opt)
+    return audio_opt
@@ -0,0 +1,164 @@
+import inspect
+import os
+import traceback
+
+import numpy as np
+import torch
+
+from infer_pack.models_onnx import SynthesizerTrnMsNSFsidM
+from mdx import session_pool
+
+ONNX_OPSET = 17
+# maximum mean absolute difference between the torch and ONNX Runtime outputs of the exported synthesizer,
+# which only differ by the small Gaussian noise the sine generator adds to voiced frames
+ONNX_TOLERANCE = 1e-2
+
+
+def get_onnx_path(model_path):
+    return f'{os.path.splitext(model_path)[0]}.onnx'
+
+
+def get_export_kwargs():
+    """Keyword arguments of `torch.onnx.export` selecting the TorchScript exporter, which handles dynamic axes."""
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        return {'dynamo': False}
+    return {}
+
+
+def build_export_model(cpt):
+    net_g = SynthesizerTrnMsNSFsidM(*cpt['config'], is_half=False, version=cpt.get('version', 'v1'))
+    del net_g.enc_q
+    net_g.load_state_dict(cpt['weight'], strict=False)
+    net_g.dec.remove_weight_norm()
+    net_g.flow.remove_weight_norm()
+    return net_g.eval().float()
+
+
+def get_dummy_inputs(cpt, frames=200):
+    """Inputs of `SynthesizerTrnMsNSFsidM.forward`, fully voiced so the outputs are comparable."""
+    phone_channels = 256 if cpt.get('version', 'v1') == 'v1' else 768
+    generator = torch.Generator().manual_seed(0)
+    return (
+        torch.randn(1, frames, phone_channels, generator=generator),
+        torch.tensor([frames]).long(),
+        torch.randint(5, 255, (1, frames), generator=generator).long(),
+        torch.rand(1, frames, generator=generator) * 400 + 100,
+        torch.zeros(1).long(),
+        torch.zeros(1, cpt['config'][2], frames),
+    )
+
+
+def export_onnx(cpt, model_path):
+    """
+    Export the synthesizer of a voice model to ONNX with a dynamic number of frames, once.
+
+    The model is written next to the .pth file and only exported again when the .pth is newer.
+
+    Args:
+        cpt: (dict) Loaded voice model checkpoint, as prepared by `get_vc`
+        model_path: (str) Path to the .pth file
+
+    Returns:
+        str: Path to the ONNX model
+    """
+    onnx_path = get_onnx_path(model_path)
+    if os.path.exists(onnx_path) and os.path.getmtime(onnx_path) >= os.path.getmtime(model_path):
+        return onnx_path
+
+    net_g = build_export_model(cpt)
+    input_names = ['phone', 'phone_lengths', 'pitch', 'pitchf', 'ds', 'rnd']
+    tmp_path = f'{onnx_path}.{os.getpid()}.tmp'
+    torch.onnx.export(
+        net_g,
+        get_dummy_inputs(cpt),
+        tmp_path,
+        input_names=input_names,
+        output_names=['audio'],
+        dynamic_axes={'phone': [1], 'pitch': [1], 'pitchf': [1], 'rnd': [2], 'audio': [2]},
+        opset_version=ONNX_OPSET,
+        **get_export_kwargs(),
+    )
+    os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+
+def check_onnx(cpt, session, tolerance=ONNX_TOLERANCE):
+    """
+    Compare the ONNX Runtime output of the exported synthesizer with the torch one.
+
+    Returns:
+        float: Mean absolute difference between the two outputs
+
+    Raises:
+        ValueError: If the difference exceeds `tolerance`
+    """
+    inputs = get_dummy_inputs(cpt)
+    with torch.no_grad():
+        expected = build_export_model(cpt)(*inputs).numpy()
+    names = [node.name for node in session.get_inputs()]
+    output = session.run(None, {name: value.numpy() for name, value in zip(names, inputs)})[0]
+    if output.shape != expected.shape:
+        raise ValueError(f'ONNX synthesizer output shape {output.shape} does not match {expected.shape}.')
+
+    difference = float(np.abs(output - expected).mean())
+    if difference > tolerance:
+        raise ValueError(f'ONNX synthesizer differs from torch by {difference:.4f} (tolerance {tolerance}).')
+    return difference
+
+
+class OnnxSynthesizer:
+    """
+    Runs the synthesizer of a voice model with ONNX Runtime behind the `infer` interface of the torch models,
+    so `VC` can use either one as `net_g`.
+    """
+
+    def __init__(self, session, inter_channels):
+        self.session = session
+        self.inter_channels = inter_channels
+        self.input_names = [node.name for node in session.get_inputs()]
+
+    def infer(self, phone, phone_lengths, pitch, nsff0, sid, max_len=None):
+        # the graph was exported with a batch of 1 and SynthesizerTrnMsNSFsidM.forward unsqueezes the speaker
+        # embedding for a single segment, so a batched call would be silently wrong: run the segments one at a time
+        outputs = []
+        for i, length in enumerate(phone_lengths.tolist()):
+            inputs = [
+                phone[i: i + 1, :length].float(),
+                phone_lengths[i: i + 1],
+                pitch[i: i + 1, :length],
+                nsff0[i: i + 1, :length].float(),
+                sid[i: i + 1],
+                torch.randn(1, self.inter_channels, length) * 0.66666,
+            ]
+            feed = {name: value.cpu().numpy() for name, value in zip(self.input_names, inputs)}
+            outputs.append(self.session.run(None, feed)[0][0])
+
+        hop_length = outputs[0].shape[-1] // phone_lengths[0].item()
+        audio = np.zeros((len(outputs), 1, phone.shape[1] * hop_length), dtype=np.float32)
+        for i, output in enumerate(outputs):
+            audio[i, :, : output.shape[-1]] = output
+        return (torch.from_numpy(audio),)
+
+
+def load_onnx_synthesizer(cpt, model_path, providers):
+    """
+    Export (if needed), load and check the ONNX synthesizer of a voice model.
+
+    Returns:
+        OnnxSynthesizer or None: None if the voice model has no pitch or the export fails its check,
+        in which case the torch synthesizer should be used
+    """
+    if cpt.get('f0', 1) != 1:
+        print('[!] ONNX synthesizer is only available for voice models with pitch, using torch.')
+        return None
+
+    try:
+        onnx_path = export_onnx(cpt, model_path)
+        session = session_pool.get(onnx_path, providers)
+        check_onnx(cpt, session)
+    except Exception:
+        traceback.print_exc()
+        print(f'[!] ONNX synthesizer of {model_path} failed, using torch.')
+        return None
+
+    return OnnxSynthesizer(session, cpt['config'][2])
@@ -0,0 +1,198 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import soundfile as sf
+import torch
+from scipy import signal
+
+from index_cache import index_cache
+from model_manager import model_manager
+from vc_infer_pipeline import ah, bh, change_rms
+
+# harvest and the hybrid methods memoize f0 by input path, which is meaningless for a rolling buffer
+STREAM_F0_METHODS = ['rmvpe', 'pm', 'dio', 'crepe', 'crepe-tiny', 'mangio-crepe', 'mangio-crepe-tiny']
+
+
+class StreamingVC:
+    """
+    Low latency voice conversion of consecutive PCM blocks with a loaded RVC voice model.
+
+    Every call to `process` takes the next block of 16 kHz mono audio, appends it to a rolling
+    buffer holding `extra_time` seconds of past input and runs HuBERT, the f0 estimator and the
+    synthesizer on that buffer, so each block is converted with the same context a full song would
+    give it. The converted audio is emitted `crossfade_time` seconds behind the input: the last
+    crossfade of every inference (converted without right context) is only used to fade into the
+    next block, which hides the seams between blocks.
+
+    Latency is `block_time + crossfade_time` plus the time one inference takes.
+    """
+
+    def __init__(self, vc, hubert_model, net_g, version, if_f0, tgt_sr, block_time=0.25, crossfade_time=0.05,
+                 extra_time=2.0, f0_up_key=0, f0_method='rmvpe', index_path='', index_rate=0.5, filter_radius=3,
+                 rms_mix_rate=1, protect=0.33, crepe_hop_length=128, sid=0):
+        """
+        Args:
+            vc: (VC) Pipeline of the voice model, as returned by `get_vc`
+            hubert_model: (torch.nn.Module) HuBERT feature extractor
+            net_g: (torch.nn.Module) Synthesizer of the voice model
+            version: (str) Voice model version, v1 or v2
+            if_f0: (int) 1 if the voice model uses pitch
+            tgt_sr: (int) Sample rate of the voice model output
+            block_time: (float) Duration of the input blocks in seconds
+            crossfade_time: (float) Duration of the crossfade between output blocks in seconds, at most block_time
+            extra_time: (float) Seconds of past input kept as context for every inference
+            f0_up_key: (int) Pitch change in semitones
+            f0_method: (str) One of STREAM_F0_METHODS
+            index_path: (str) Path to the voice model .index file, empty to disable retrieval
+            index_rate: (float) Ratio of retrieved features mixed into the HuBERT features
+            filter_radius: (int) Median filter radius for f0
+            rms_mix_rate: (float) Ratio of the output volume envelope kept, 1 keeps the output envelope
+            protect: (float) Protection of voiceless consonants and breath sounds, 0.5 disables it
+            crepe_hop_length: (int) Hop length of the mangio-crepe f0 methods
+            sid: (int) Speaker id
+        """
+        if f0_method not in STREAM_F0_METHODS:
+            raise ValueError(f'f0 method {f0_method} cannot be used for streaming, use one of {STREAM_F0_METHODS}.')
+
+        self.vc = vc
+        self.hubert_model = hubert_model
+        self.net_g = net_g
+        self.version = version
+        self.if_f0 = if_f0
+        self.tgt_sr = tgt_sr
+        self.f0_up_key = f0_up_key
+        self.f0_method = f0_method
+        self.index_rate = index_rate
+        self.filter_radius = filter_radius
+        self.rms_mix_rate = rms_mix_rate
+        self.protect = protect
+        self.crepe_hop_length = crepe_hop_length
+        self.sid = torch.tensor([sid], device=vc.device).long()
+        self.times = [0, 0, 0]
+
+        if index_path and os.path.exists(index_path) and index_rate != 0:
+            self.index, self.big_npy = index_cache.get(index_path)
+        else:
+            self.index = self.big_npy = None
+
+        # all sizes are whole f0 frames, so input frames and output samples line up exactly
+        self.block_size = self.to_frames(block_time)
+        self.crossfade_size = min(self.to_frames(crossfade_time), self.block_size)
+        self.extra_size = self.to_frames(extra_time)
+        # reflected right padding so that HuBERT rounding never eats into the emitted samples
+        self.pad_size = self.to_frames(0.1)
+
+        self.tgt_block_size = self.block_size * tgt_sr // vc.sr
+        self.tgt_crossfade_size = self.crossfade_size * tgt_sr // vc.sr
+        fade = np.sin(0.5 * np.pi * np.linspace(0, 1, self.tgt_crossfade_size, dtype=np.float32)) ** 2
+        self.fade_in, self.fade_out = fade, 1 - fade
+        self.reset()
+
+    @classmethod
+    def from_voice_model(cls, rvc_model_path, rvc_index_path='', voice_model=None, device='cuda:0', is_half=True, **kwargs):
+        """Build a stream with the models held by `model_manager`, loading them if needed."""
+        config = model_manager.get_config(device, is_half)
+        hubert_model = model_manager.get_hubert(config.device, config.is_half)
+        voice_model = voice_model or os.path.basename(os.path.dirname(rvc_model_path))
+        cpt, version, net_g, tgt_sr, vc = model_manager.get_voice_model(voice_model, rvc_model_path, config)
+        return cls(vc, hubert_model, net_g, version, cpt.get('f0', 1), tgt_sr, index_path=rvc_index_path, **kwargs)
+
+    def to_frames(self, seconds):
+        return max(1, int(round(seconds * self.vc.sr / self.vc.window))) * self.vc.window
+
+    @property
+    def latency(self):
+        """Algorithmic latency in seconds, excluding the inference time."""
+        return (self.block_size + self.crossfade_size) / self.vc.sr
+
+    def reset(self):
+        """Forget the past input, e.g. before starting an unrelated stream."""
+        self.input_buffer = np.zeros(self.extra_size + self.crossfade_size + self.block_size, dtype=np.float32)
+        self.filter_state = signal.lfilter_zi(bh, ah) * 0
+        self.prev_tail = None
+
+    def process(self, block):
+        """
+        Convert the next block of input.
+
+        Args:
+            block: (np.ndarray) 16 kHz mono samples in [-1, 1], at most `block_size` long; shorter blocks
+                (e.g. the end of a stream) are padded with silence
+
+        Returns:
+            np.ndarray: `tgt_block_size` float32 samples at `tgt_sr`
+        """
+        block = np.asarray(block, dtype=np.float32).reshape(-1)
+        if block.shape[0] > self.block_size:
+            raise ValueError(f'Block of {block.shape[0]} samples is longer than the block size of {self.block_size}.')
+        block = np.pad(block, (0, self.block_size - block.shape[0]))
+
+        # causal version of the high-pass filter the offline pipeline applies with filtfilt
+        block, self.filter_state = signal.lfilter(bh, ah, block, zi=self.filter_state)
+        self.input_buffer = np.concatenate([self.input_buffer[self.block_size:], block.astype(np.float32)])
+        audio = np.pad(self.input_buffer, (0, self.pad_size), mode='reflect')
+
+        pitch, pitchf = None, None
+        if self.if_f0 == 1:
+            p_len = audio.shape[0] // self.vc.window
+            pitch, pitchf = self.vc.get_f0('', audio, p_len, self.f0_up_key, self.f0_method, self.filter_radius, self.crepe_hop_length)
+            pitch = torch.tensor(pitch[:p_len], device=self.vc.device).unsqueeze(0).long()
+            pitchf = torch.tensor(pitchf[:p_len].astype(np.float32), device=self.vc.device).unsqueeze(0).float()
+
+        audio_opt = self.vc.vc(self.hubert_model, self.net_g, self.sid, audio, pitch, pitchf, self.times, self.index,
+                               self.big_npy, self.index_rate, self.version, self.protect)
+        audio_opt = audio_opt[:self.input_buffer.shape[0] * self.tgt_sr // self.vc.sr]
+        if self.rms_mix_rate != 1:
+            audio_opt = change_rms(self.input_buffer, self.vc.sr, audio_opt, self.tgt_sr, self.rms_mix_rate)
+
+        # [crossfade | block | crossfade] is the end of the output; emit the block delayed by one crossfade
+        tail = audio_opt[audio_opt.shape[0] - self.tgt_block_size - self.tgt_crossfade_size:]
+        out = tail[:self.tgt_block_size].copy()
+        if self.prev_tail is not None:
+            out[:self.tgt_crossfade_size] = out[:self.tgt_crossfade_size] * self.fade_in + self.prev_tail * self.fade_out
+        self.prev_tail = tail[self.tgt_block_size:].copy()
+        return out
+
+    def flush(self):
+        """Returns the last crossfade of converted audio, faded out, and resets the stream."""
+        tail = np.zeros(self.tgt_crossfade_size, dtype=np.float32) if self.prev_tail is None else self.prev_tail * self.fade_out
+        self.reset()
+        return tail
+
+
+if __name__ == '__main__':
+    from main import get_rvc_model
+    from my_utils import load_audio
+
+    parser = argparse.ArgumentParser(description='Convert an audio file block by block like a live stream and report the latency.', add_help=True)
+    parser.add_argument('-i', '--input', type=str, required=True, help='Audio file to stream, e.g. a clean vocal recording')
+    parser.add_argument('-dir', '--rvc-dirname', type=str, required=True, help='Name of the folder in the rvc_models directory containing the RVC model file and optional index file to use')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Output WAV file')
+    parser.add_argument('-p', '--pitch-change', type=int, default=0, help='Change the pitch of the voice in semitones')
+    parser.add_argument('-ir', '--index-rate', type=float, default=0.5, help='Ratio of the retrieved features used, between 0 and 1')
+    parser.add_argument('-palgo', '--pitch-detection-algo', type=str, default='rmvpe', choices=STREAM_F0_METHODS, help='Pitch detection algorithm')
+    parser.add_argument('-pro', '--protect', type=float, default=0.33, help='Protect voiceless consonants and breath sounds, 0.5 to disable')
+    parser.add_argument('--block-time', type=float, default=0.25, help='Duration of each input block in seconds')
+    parser.add_argument('--crossfade-time', type=float, default=0.05, help='Duration of the crossfade between output blocks in seconds')
+    parser.add_argument('--extra-time', type=float, default=2.0, help='Seconds of past input used as context for each block')
+    args = parser.parse_args()
+
+    rvc_model_path, rvc_index_path = get_rvc_model(args.rvc_dirname, False)
+    stream = StreamingVC.from_voice_model(rvc_model_path, rvc_index_path, args.rvc_dirname, f0_up_key=args.pitch_change,
+                                          f0_method=args.pitch_detection_algo, index_rate=args.index_rate, protect=args.protect,
+                                          block_time=args.block_time, crossfade_time=args.crossfade_time, extra_time=args.extra_time)
+
+    audio = load_audio(args.input, 16000)
+    outputs, durations = [], []
+    for start in range(0, audio.shape[0], stream.block_size):
+        t0 = time.perf_counter()
+        outputs.append(stream.process(audio[start:start + stream.block_size]))
+        durations.append(time.perf_counter() - t0)
+    outputs.append(stream.flush())
+    sf.write(args.output, np.concatenate(outputs), stream.tgt_sr)
+
+    block_time = stream.block_size / 16000
+    print(f'[+] {len(durations)} blocks of {block_time * 1000:.0f} ms, inference {np.mean(durations) * 1000:.0f} ms mean / {np.max(durations) * 1000:.0f} ms max')
+    print(f'[+] Latency: {(stream.latency + np.max(durations)) * 1000:.0f} ms worst case, real time factor {np.mean(durations) / block_time:.2f}')
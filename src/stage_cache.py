@@ -0,0 +1,342 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+
+import numpy as np
+import soundfile as sf
+
+try:
+    import fcntl
+except ImportError:
+    # no inter-process lock on Windows, one process per cache directory
+    fcntl = None
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+# seconds between writes of the last access times recorded by `get`
+TOUCH_FLUSH_INTERVAL = 30
+
+
+def is_running(pid):
+    if fcntl is None:
+        # os.kill would terminate the process on Windows, where a cache directory has a single process
+        return pid == os.getpid()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class StageCache:
+    """
+    Content-addressed cache for the outputs of pipeline stages (e.g. the MDX separations).
+
+    Each entry is a directory of files stored under a key derived from the stage inputs, and is
+    recorded in `manifest.json` with its size and creation / last access timestamps. When the total
+    size of the cache exceeds `max_bytes`, the least recently used entries are evicted.
+
+    Several processes can share a cache directory (e.g. the WebUI and `batch.py`): the manifest is read
+    and written back under a lock on `manifest.lock` when entries are added or evicted, and entries leased
+    by a running job (see `acquire_lease`) are not evicted. Lookups only read the manifest when it changed
+    and write their access times back at most every TOUCH_FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.lock_path = os.path.join(cache_dir, 'manifest.lock')
+        self.leases_dir = os.path.join(cache_dir, 'leases')
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._touched = {}
+        self._last_flush = time.time()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stage-cache-writer')
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Build a cache key from the identity of a stage: input hash / parent key, model hash and parameters.
+
+        Args:
+            parts: JSON serializable values identifying the stage output
+
+        Returns:
+            str: Hex digest used as the entry key
+        """
+        payload = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the manifest against the other threads and, where fcntl exists, the other processes."""
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.lock_path, 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # closing the file releases the lock
+                yield
+
+    def _load_manifest(self):
+        """Read the manifest from disk, other processes may have changed it since the last operation."""
+        try:
+            with open(self.manifest_path) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+    def _peek_manifest(self):
+        """The manifest for lookups, only read again from disk when another write replaced it."""
+        try:
+            stat = os.stat(self.manifest_path)
+        except OSError:
+            return {}
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._snapshot is None or self._snapshot[0] != version:
+            self._snapshot = (version, self._load_manifest())
+        return self._snapshot[1]
+
+    def _apply_touched(self, manifest):
+        touched, self._touched = self._touched, {}
+        for key, last_used in touched.items():
+            if key in manifest:
+                manifest[key]['last_used'] = max(manifest[key]['last_used'], last_used)
+        self._last_flush = time.time()
+
+    def flush(self):
+        """Write the access times recorded by `get` to the manifest."""
+        with self._locked():
+            manifest = self._load_manifest()
+            self._apply_touched(manifest)
+            self._save_manifest(manifest)
+
+    def _save_manifest(self, manifest):
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def staging_dir(self, key):
+        """Directory where a stage can write its outputs before they are registered with `put`."""
+        path = os.path.join(self.cache_dir, 'staging', f'{key}.{os.getpid()}.{threading.get_ident()}')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used.
+
+        Returns:
+            dict or None: {'files': {name: path}, 'meta': dict} if every file of the entry exists, else None
+        """
+        with self._lock:
+            entry = self._peek_manifest().get(key)
+            if entry is None:
+                return None
+            # incomplete entries are replaced by the next `put` of the key
+            files = self._entry_files(key, entry)
+            if not all(os.path.exists(path) for path in files.values()):
+                return None
+            self._touched[key] = time.time()
+            flush = time.time() - self._last_flush > TOUCH_FLUSH_INTERVAL
+
+        if flush:
+            self.flush()
+        return {'files': files, 'meta': entry.get('meta', {})}
+
+    def get_array(self, key, name):
+        """
+        Load an array stored with `put_arrays`.
+
+        Returns:
+            np.ndarray or None: None if the entry is missing, including when another process evicts it
+            between the lookup and the read
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        try:
+            return np.load(entry['files'][name])
+        except FileNotFoundError:
+            return None
+
+    def _entry_files(self, key, entry):
+        return {name: os.path.join(self.entry_dir(key), filename) for name, filename in entry['files'].items()}
+
+    def put(self, key, files, meta=None, protect=()):
+        """
+        Move files into the cache under `key` and evict old entries if the quota is exceeded.
+
+        If another job already stored a complete entry under `key`, it is kept (it may be leased and
+        read) and `files` are deleted instead.
+
+        Args:
+            key: (str) Entry key from `make_key`
+            files: (dict) Mapping of output name to the path of the file to store
+            meta: (dict) Extra JSON serializable information kept in the manifest
+            protect: (iterable) Keys that must not be evicted, e.g. entries the current job still reads
+
+        Returns:
+            dict: Mapping of output name to the cached file path
+        """
+        with self._locked():
+            manifest = self._load_manifest()
+            self._apply_touched(manifest)
+            if key in manifest:
+                existing_files = self._entry_files(key, manifest[key])
+                if all(os.path.exists(path) for path in existing_files.values()):
+                    for path in files.values():
+                        if path not in existing_files.values():
+                            with suppress(OSError):
+                                os.remove(path)
+                    manifest[key]['last_used'] = time.time()
+                    self._save_manifest(manifest)
+                    return existing_files
+                self._remove(manifest, key)
+
+            entry_dir = self.entry_dir(key)
+            os.makedirs(entry_dir, exist_ok=True)
+            cached_files, size = {}, 0
+            for name, path in files.items():
+                filename = os.path.basename(path)
+                cached_path = os.path.join(entry_dir, filename)
+                if os.path.abspath(path) != os.path.abspath(cached_path):
+                    shutil.move(path, cached_path)
+                cached_files[name] = filename
+                size += os.path.getsize(cached_path)
+
+            now = time.time()
+            manifest[key] = {'files': cached_files, 'size': size, 'created': now, 'last_used': now, 'meta': meta or {}}
+            self._evict(manifest, protect={key, *protect})
+            self._save_manifest(manifest)
+            return {name: os.path.join(entry_dir, filename) for name, filename in cached_files.items()}
+
+    def put_waves(self, key, waves, meta=None, protect=()):
+        """
+        Write in-memory waves to WAV files on a background thread and store them under `key`.
+
+        Args:
+            key: (str) Entry key from `make_key`
+            waves: (dict) Mapping of output name to (file name, wave with shape (channels, samples), sample rate)
+            meta: (dict) Extra JSON serializable information kept in the manifest
+            protect: (iterable) Keys that must not be evicted
+
+        Returns:
+            concurrent.futures.Future: Resolves to the mapping of output name to the cached file path
+        """
+        def write():
+            staging_dir = self.staging_dir(key)
+            files = {}
+            for name, (filename, wave, sr) in waves.items():
+                files[name] = os.path.join(staging_dir, filename)
+                sf.write(files[name], wave.T, sr)
+            cached_files = self.put(key, files, meta, protect)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return cached_files
+
+        return self._writer.submit(write)
+
+    def put_arrays(self, key, arrays, meta=None, protect=()):
+        """
+        Save NumPy arrays as .npy files and store them under `key`.
+
+        Args:
+            key: (str) Entry key from `make_key`
+            arrays: (dict) Mapping of output name to array, saved as `<name>.npy`
+            meta: (dict) Extra JSON serializable information kept in the manifest
+            protect: (iterable) Keys that must not be evicted
+
+        Returns:
+            dict: Mapping of output name to the cached file path, loaded with `np.load`
+        """
+        staging_dir = self.staging_dir(key)
+        files = {}
+        for name, array in arrays.items():
+            files[name] = os.path.join(staging_dir, f'{name}.npy')
+            np.save(files[name], array)
+        cached_files = self.put(key, files, meta, protect)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return cached_files
+
+    def acquire_lease(self, keys):
+        """
+        Keep entries from being evicted by any process sharing the cache while a job reads them.
+
+        Keys do not need to be cached yet, so a job can lease the entries it is about to look up or
+        create. Leases of processes that died are ignored.
+
+        Args:
+            keys: (iterable) Entry keys from `make_key`
+
+        Returns:
+            str: Lease to pass to `release_lease`
+        """
+        os.makedirs(self.leases_dir, exist_ok=True)
+        lease = os.path.join(self.leases_dir, f'{os.getpid()}.{uuid.uuid4().hex}.json')
+        tmp_path = f'{lease}.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(list(keys), outfile)
+        os.replace(tmp_path, lease)
+        return lease
+
+    def release_lease(self, lease):
+        with suppress(OSError):
+            os.remove(lease)
+
+    @contextmanager
+    def leased(self, keys):
+        lease = self.acquire_lease(keys)
+        try:
+            yield
+        finally:
+            self.release_lease(lease)
+
+    def _leased_keys(self):
+        keys = set()
+        with suppress(OSError):
+            for filename in os.listdir(self.leases_dir):
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(self.leases_dir, filename)
+                pid = filename.split('.')[0]
+                if pid.isdigit() and not is_running(int(pid)):
+                    self.release_lease(path)
+                    continue
+                with suppress(OSError, ValueError):
+                    with open(path) as infile:
+                        keys.update(json.load(infile))
+        return keys
+
+    def total_size(self):
+        with self._locked():
+            return sum(entry['size'] for entry in self._load_manifest().values())
+
+    def _remove(self, manifest, key):
+        manifest.pop(key, None)
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def _evict(self, manifest, protect=()):
+        total = sum(entry['size'] for entry in manifest.values())
+        if total <= self.max_bytes:
+            return
+        protect = {*protect, *self._leased_keys()}
+        for key in sorted(manifest, key=lambda k: manifest[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key in protect:
+                continue
+            total -= manifest[key]['size']
+            self._remove(manifest, key)
@@ -0,0 +1,148 @@
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+_log_lock = threading.Lock()
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process (Linux only), so the next reading covers one stage."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """Peak resident set size of the process in bytes, since the last `reset_peak_rss`."""
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # peak since the process started, in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_io_bytes():
+    """Bytes the process has read and written through system calls (files, pipes and sockets), or None."""
+    try:
+        with open('/proc/self/io') as infile:
+            counters = dict(line.split(': ') for line in infile.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class StageRecord:
+    """Handed out by `StageMeter.measure`, lets the stage report its cache lookups."""
+
+    def __init__(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def cache_hit(self, hit=True):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+
+class StageMeter:
+    """
+    Wall time, CPU time, bytes read and written, peak RSS and cache hits of the named stages of a job.
+
+    Measuring a stage several times (e.g. once per batch of segments) adds up the times, bytes and
+    cache lookups and keeps the highest peak. CPU time, bytes and peak RSS are process-wide, so they
+    include the work of other threads running at the same time.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name):
+        record = StageRecord()
+        reset_peak_rss()
+        start_io = get_io_bytes()
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall_time, cpu_time = time.perf_counter() - start_time, time.process_time() - start_cpu
+            # bytes first, so reading /proc/self/status for the peak is not counted
+            end_io, peak_rss = get_io_bytes(), get_peak_rss()
+            with self._lock:
+                stage = self.stages.setdefault(name, {
+                    'wall_time': 0.0, 'cpu_time': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'peak_rss': 0,
+                    'cache_hits': 0, 'cache_misses': 0, 'calls': 0,
+                })
+                stage['wall_time'] += wall_time
+                stage['cpu_time'] += cpu_time
+                if start_io is not None and end_io is not None:
+                    stage['read_bytes'] += end_io[0] - start_io[0]
+                    stage['write_bytes'] += end_io[1] - start_io[1]
+                stage['peak_rss'] = max(stage['peak_rss'], peak_rss)
+                stage['cache_hits'] += record.cache_hits
+                stage['cache_misses'] += record.cache_misses
+                stage['calls'] += 1
+
+
+class JobReport(StageMeter):
+    """
+    Stage records of one cover job with its parameters, outcome and outputs.
+
+    `multi_voice_cover_pipeline` fills the report it is given and appends it to its JSONL log as one
+    line, so slow stages can be found across jobs.
+    """
+
+    def __init__(self, job_id=None, **params):
+        super().__init__()
+        self.job_id = uuid.uuid4().hex[:12] if job_id is None else job_id
+        self.params = params
+        self.started = time.time()
+        self.finished = None
+        self.status = 'running'
+        self.error = None
+        self.outputs = []
+
+    def finish(self, status='ok', outputs=(), error=None):
+        self.finished = time.time()
+        self.status = status
+        self.outputs = list(outputs)
+        self.error = error
+
+    def to_dict(self):
+        return {
+            'id': self.job_id,
+            'params': self.params,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'duration': round((self.finished or time.time()) - self.started, 3),
+            'status': self.status,
+            'error': self.error,
+            'outputs': self.outputs,
+            'stages': {name: {key: round(value, 4) if isinstance(value, float) else value for key, value in stage.items()}
+                       for name, stage in self.stages.items()},
+        }
+
+    def write(self, log_path):
+        """Append the report to a JSONL log."""
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        line = json.dumps(self.to_dict(), default=str)
+        with _log_lock, open(log_path, 'a') as outfile:
+            outfile.write(line + '\n')
+
+
+def measure(meter, name):
+    """`meter.measure(name)`, or a no-op yielding a throwaway StageRecord when no meter is given."""
+    return nullcontext(StageRecord()) if meter is None else meter.measure(name)
@@ -1,7 +1,7 @@
+import hashlib
 from functools import lru_cache
 from time import time as ttime
 
-import faiss
 import librosa
 import numpy as np
 import os
@@ -14,6 +14,11 @@ import torchcrepe
 import traceback
 from scipy import signal
 from torch import Tensor
+from torch.nn.utils.rnn import pad_sequence
+
+from index_cache import index_cache
+from infer_pack import commons
+from stage_meter import measure
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 now_dir = os.path.join(BASE_DIR, 'src')
@@ -60,6 +65,33 @@ def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出
     return data2
 
 
+def plan_splits(audio, window, t_center, t_query, low_energy=False):
+    """
+    Pick the sample positions where a long input is cut into segments for inference.
+
+    A cut is placed near every multiple of `t_center`, at the point within `t_query` samples of it
+    where the moving sum over `window` samples is closest to zero (or, with `low_energy`, where the
+    moving energy is lowest, which keeps cuts in pauses rather than at zero crossings of the mean).
+
+    Returns:
+        list: Cut positions in samples, in increasing order
+    """
+    centers = np.arange(t_center, audio.shape[0], t_center)
+    if centers.shape[0] == 0:
+        return []
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+    if low_energy:
+        audio_pad = np.square(audio_pad)
+    # moving sum of `window` samples centered on every input sample, from a cumulative sum
+    cumsum = np.concatenate([[0.0], np.cumsum(audio_pad, dtype=np.float64)])
+    audio_sum = np.abs(cumsum[window : window + audio.shape[0]] - cumsum[: audio.shape[0]])
+    # query regions running past the end are padded with inf so they can never be picked there
+    audio_sum = np.pad(audio_sum, (0, t_query), constant_values=np.inf)
+    regions = np.lib.stride_tricks.sliding_window_view(audio_sum, 2 * t_query)
+    starts = centers - t_query
+    return (starts + regions[starts].argmin(axis=1)).tolist()
+
+
 class VC(object):
     def __init__(self, tgt_sr, config):
         self.x_pad, self.x_query, self.x_center, self.x_max, self.is_half = (
@@ -78,6 +110,7 @@ class VC(object):
         self.t_center = self.sr * self.x_center  # 查询切点位置
         self.t_max = self.sr * self.x_max  # 免查询时长阈值
         self.device = config.device
+        self.batch_size = config.vc_batch_size  # 同时推理的切片数
 
     # Fork Feature: Get the best torch device to use for f0 algorithms that require a torch device. Will return the type (torch.device)
     def get_optimal_torch_device(self, index: int = 0) -> torch.device:
@@ -259,23 +292,19 @@ class VC(object):
             f0_median_hybrid = np.nanmedian(f0_computation_stack, axis=0)
         return f0_median_hybrid
 
-    def get_f0(
+    def compute_f0(
         self,
         input_audio_path,
         x,
         p_len,
-        f0_up_key,
         f0_method,
         filter_radius,
         crepe_hop_length,
-        inp_f0=None,
     ):
         global input_audio_path2wav
         time_step = self.window / self.sr * 1000
         f0_min = 50
         f0_max = 1100
-        f0_mel_min = 1127 * np.log(1 + f0_min / 700)
-        f0_mel_max = 1127 * np.log(1 + f0_max / 700)
         if f0_method == "pm":
             f0 = (
                 parselmouth.Sound(x, self.sr)
@@ -321,11 +350,9 @@ class VC(object):
             )
         elif f0_method == "rmvpe":
             if hasattr(self, "model_rmvpe") == False:
-                from rmvpe import RMVPE
+                from model_manager import model_manager
 
-                self.model_rmvpe = RMVPE(
-                    os.path.join(BASE_DIR, 'rvc_models', 'rmvpe.pt'), is_half=self.is_half, device=self.device
-                )
+                self.model_rmvpe = model_manager.get_rmvpe(self.device, self.is_half)
             f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
 
         elif "hybrid" in f0_method:
@@ -342,8 +369,50 @@ class VC(object):
                 crepe_hop_length,
                 time_step,
             )
+        return f0
 
-        f0 *= pow(2, f0_up_key / 12)
+    def get_f0(
+        self,
+        input_audio_path,
+        x,
+        p_len,
+        f0_up_key,
+        f0_method,
+        filter_radius,
+        crepe_hop_length,
+        inp_f0=None,
+        cache=None,
+        stage=None,
+    ):
+        f0_min = 50
+        f0_max = 1100
+        f0_mel_min = 1127 * np.log(1 + f0_min / 700)
+        f0_mel_max = 1127 * np.log(1 + f0_max / 700)
+        if cache is None:
+            f0 = self.compute_f0(
+                input_audio_path, x, p_len, f0_method, filter_radius, crepe_hop_length
+            )
+        else:
+            # the unshifted curve only depends on the audio and the f0 method settings,
+            # so retries with another pitch change reuse it
+            f0_params = [f0_method, self.is_half]
+            if "harvest" in f0_method:
+                f0_params.append(filter_radius)
+            if "mangio-crepe" in f0_method:
+                f0_params.append(crepe_hop_length)
+            key = cache.make_key(
+                "f0", hashlib.blake2b(x.tobytes(), digest_size=16).hexdigest(), f0_params
+            )
+            f0 = cache.get_array(key, "f0")
+            if stage is not None:
+                stage.cache_hit(f0 is not None)
+            if f0 is None:
+                f0 = self.compute_f0(
+                    input_audio_path, x, p_len, f0_method, filter_radius, crepe_hop_length
+                )
+                cache.put_arrays(key, {"f0": f0}, meta={"stage": "f0", "f0_method": f0_method})
+
+        f0 = f0 * pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
         tf0 = self.sr // self.window  # 每秒f0点数
         if inp_f0 is not None:
@@ -369,107 +438,224 @@ class VC(object):
 
         return f0_coarse, f0bak  # 1-0
 
-    def vc(
+    def extract_features(self, model, audios, version):
+        """
+        HuBERT features of several segments with one pass of the transformer encoder.
+
+        The convolutional feature extractor normalizes over the whole input, so it runs on each
+        segment separately; its outputs are padded into a batch and the encoder masks the padding.
+
+        Returns:
+            tuple: (features with shape (batch, max frames, channels), list of frame counts)
+        """
+        convs = []
+        for audio0 in audios:
+            source = torch.from_numpy(audio0)
+            if self.is_half:
+                source = source.half()
+            else:
+                source = source.float()
+            if source.dim() == 2:  # double channels
+                source = source.mean(-1)
+            assert source.dim() == 1, source.dim()
+            convs.append(model.forward_features(source.view(1, -1).to(self.device))[0].transpose(0, 1))
+        lengths = [conv.shape[0] for conv in convs]
+        features = pad_sequence(convs, batch_first=True)
+        padding_mask = ~commons.sequence_mask(
+            torch.tensor(lengths, device=self.device), features.shape[1]
+        )
+        features = model.layer_norm(features)
+        if model.post_extract_proj is not None:
+            features = model.post_extract_proj(features)
+        feats, _ = model.encoder(
+            features,
+            padding_mask=padding_mask,
+            layer=(9 if version == "v1" else 12) - 1,
+        )
+        if version == "v1":
+            feats = model.final_proj(feats)
+        return feats, lengths
+
+    def get_features(self, model, audios, version, cache=None, stage=None):
+        """
+        `extract_features` with the features of every segment looked up in `cache` first.
+
+        The features only depend on the segment audio, the HuBERT checkpoint and the output layer,
+        so they are shared by every voice model, index rate and protect value. They are stored as
+        float16 .npy entries and only the segments that miss are run through HuBERT. Every lookup
+        is reported to `stage` (a StageRecord), if given.
+        """
+        if cache is None or not hasattr(model, "checkpoint_hash"):
+            return self.extract_features(model, audios, version)
+
+        keys = [
+            cache.make_key(
+                "hubert",
+                hashlib.blake2b(audio0.tobytes(), digest_size=16).hexdigest(),
+                model.checkpoint_hash,
+                version,  # v1: layer 9 + final_proj, v2: layer 12
+                self.is_half,
+            )
+            for audio0 in audios
+        ]
+        segments = []
+        for key in keys:
+            # every frame of the segment is used, so the features are read whole
+            feats = cache.get_array(key, "feats")
+            if stage is not None:
+                stage.cache_hit(feats is not None)
+            segments.append(None if feats is None else torch.from_numpy(feats))
+
+        missing = [i for i, segment in enumerate(segments) if segment is None]
+        if missing:
+            feats, lengths = self.extract_features(model, [audios[i] for i in missing], version)
+            for i, feat, length in zip(missing, feats, lengths):
+                segments[i] = feat[:length]
+                cache.put_arrays(
+                    keys[i],
+                    {"feats": segments[i].cpu().numpy().astype(np.float16)},
+                    meta={"stage": "hubert"},
+                )
+
+        dtype = torch.float16 if self.is_half else torch.float32
+        segments = [segment.to(self.device, dtype) for segment in segments]
+        return pad_sequence(segments, batch_first=True), [segment.shape[0] for segment in segments]
+
+    def vc_batch(
         self,
         model,
         net_g,
         sid,
-        audio0,
-        pitch,
-        pitchf,
+        audios,
+        pitches,
+        pitchfs,
         times,
         index,
         big_npy,
         index_rate,
         version,
         protect,
-    ):  # ,file_index,file_big_npy
-        feats = torch.from_numpy(audio0)
-        if self.is_half:
-            feats = feats.half()
-        else:
-            feats = feats.float()
-        if feats.dim() == 2:  # double channels
-            feats = feats.mean(-1)
-        assert feats.dim() == 1, feats.dim()
-        feats = feats.view(1, -1)
-        padding_mask = torch.BoolTensor(feats.shape).to(self.device).fill_(False)
-
-        inputs = {
-            "source": feats.to(self.device),
-            "padding_mask": padding_mask,
-            "output_layer": 9 if version == "v1" else 12,
-        }
+        feature_cache=None,
+        meter=None,
+    ):
+        """
+        Convert several segments at once: HuBERT, index retrieval and the synthesizer each run once
+        for the whole batch, with the segments padded to the longest one and masked by their lengths.
+
+        Args:
+            audios: (list) 16 kHz segments
+            pitches: (list) Coarse pitch of each segment with shape (1, frames), or None without f0
+            pitchfs: (list) f0 of each segment with shape (1, frames), or None without f0
+            feature_cache: (StageCache) Cache of HuBERT features, see `get_features`
+            meter: (StageMeter) Records the hubert, retrieval and synthesis stages
+
+        Returns:
+            list: Converted segment of each input, at the voice model sample rate
+        """
+        if_f0 = pitches is not None and pitchfs is not None
         t0 = ttime()
-        with torch.no_grad():
-            logits = model.extract_features(**inputs)
-            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
-        if protect < 0.5 and pitch != None and pitchf != None:
+        with torch.no_grad(), measure(meter, "hubert") as stage:
+            feats, lengths = self.get_features(model, audios, version, feature_cache, stage)
+        if protect < 0.5 and if_f0:
             feats0 = feats.clone()
         if (
             isinstance(index, type(None)) == False
             and isinstance(big_npy, type(None)) == False
             and index_rate != 0
         ):
-            npy = feats[0].cpu().numpy()
-            if self.is_half:
-                npy = npy.astype("float32")
+            with measure(meter, "retrieval"):
+                npy = torch.cat([feats[i, :length] for i, length in enumerate(lengths)])
+                npy = npy.cpu().numpy().astype("float32")
 
-            # _, I = index.search(npy, 1)
-            # npy = big_npy[I.squeeze()]
+                score, ix = index.search(npy, k=8)
+                weight = np.square(1 / score)
+                weight /= weight.sum(axis=1, keepdims=True)
+                npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
 
-            score, ix = index.search(npy, k=8)
-            weight = np.square(1 / score)
-            weight /= weight.sum(axis=1, keepdims=True)
-            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
-
-            if self.is_half:
-                npy = npy.astype("float16")
-            feats = (
-                torch.from_numpy(npy).unsqueeze(0).to(self.device) * index_rate
-                + (1 - index_rate) * feats
-            )
+                if self.is_half:
+                    npy = npy.astype("float16")
+                npy = torch.from_numpy(npy).to(self.device)
+                retrieved = torch.zeros_like(feats)
+                for i, segment in enumerate(torch.split(npy, lengths)):
+                    retrieved[i, : lengths[i]] = segment
+                feats = retrieved * index_rate + (1 - index_rate) * feats
 
         feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
-        if protect < 0.5 and pitch != None and pitchf != None:
+        if protect < 0.5 and if_f0:
             feats0 = F.interpolate(feats0.permute(0, 2, 1), scale_factor=2).permute(
                 0, 2, 1
             )
         t1 = ttime()
-        p_len = audio0.shape[0] // self.window
-        if feats.shape[1] < p_len:
-            p_len = feats.shape[1]
-            if pitch != None and pitchf != None:
-                pitch = pitch[:, :p_len]
-                pitchf = pitchf[:, :p_len]
-
-        if protect < 0.5 and pitch != None and pitchf != None:
+        p_lens = [
+            min(audio0.shape[0] // self.window, length * 2)
+            for audio0, length in zip(audios, lengths)
+        ]
+        if if_f0:
+            p_lens = [min(p_len, pitch.shape[1]) for p_len, pitch in zip(p_lens, pitches)]
+        max_len = max(p_lens)
+        feats = feats[:, :max_len]
+        if if_f0:
+            pitch = torch.zeros(len(audios), max_len, dtype=torch.long, device=self.device)
+            pitchf = torch.zeros(len(audios), max_len, device=self.device)
+            for i, p_len in enumerate(p_lens):
+                pitch[i, :p_len] = pitches[i][0, :p_len]
+                pitchf[i, :p_len] = pitchfs[i][0, :p_len]
+
+        if protect < 0.5 and if_f0:
+            feats0 = feats0[:, :max_len]
             pitchff = pitchf.clone()
             pitchff[pitchf > 0] = 1
             pitchff[pitchf < 1] = protect
             pitchff = pitchff.unsqueeze(-1)
             feats = feats * pitchff + feats0 * (1 - pitchff)
             feats = feats.to(feats0.dtype)
-        p_len = torch.tensor([p_len], device=self.device).long()
-        with torch.no_grad():
-            if pitch != None and pitchf != None:
-                audio1 = (
-                    (net_g.infer(feats, p_len, pitch, pitchf, sid)[0][0, 0])
-                    .data.cpu()
-                    .float()
-                    .numpy()
-                )
+        p_len = torch.tensor(p_lens, device=self.device).long()
+        sid = sid.repeat(len(audios))
+        with torch.no_grad(), measure(meter, "synthesis"):
+            if if_f0:
+                audio1 = net_g.infer(feats, p_len, pitch, pitchf, sid)[0][:, 0]
             else:
-                audio1 = (
-                    (net_g.infer(feats, p_len, sid)[0][0, 0]).data.cpu().float().numpy()
-                )
-        del feats, p_len, padding_mask
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+                audio1 = net_g.infer(feats, p_len, sid)[0][:, 0]
+            audio1 = audio1.data.cpu().float().numpy()
+        hop_length = audio1.shape[1] // max_len
+        audio_opt = [audio1[i, : p_len * hop_length] for i, p_len in enumerate(p_lens)]
+        del feats, p_len, audio1
         t2 = ttime()
         times[0] += t1 - t0
         times[2] += t2 - t1
-        return audio1
+        return audio_opt
+
+    def vc(
+        self,
+        model,
+        net_g,
+        sid,
+        audio0,
+        pitch,
+        pitchf,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+        meter=None,
+    ):  # ,file_index,file_big_npy
+        return self.vc_batch(
+            model,
+            net_g,
+            sid,
+            [audio0],
+            [pitch] if pitch is not None else None,
+            [pitchf] if pitchf is not None else None,
+            times,
+            index,
+            big_npy,
+            index_rate,
+            version,
+            protect,
+            meter=meter,
+        )[0]
 
     def pipeline(
         self,
@@ -493,6 +679,9 @@ class VC(object):
         protect,
         crepe_hop_length,
         f0_file=None,
+        cache=None,
+        feature_cache=None,
+        meter=None,
     ):
         if (
             file_index != ""
@@ -502,33 +691,19 @@ class VC(object):
             and index_rate != 0
         ):
             try:
-                index = faiss.read_index(file_index)
-                # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
+                # loaded once per voice model; the vectors are memory-mapped from the sidecar .npy
+                index, big_npy = index_cache.get(file_index)
             except:
                 traceback.print_exc()
                 index = big_npy = None
         else:
             index = big_npy = None
         audio = signal.filtfilt(bh, ah, audio)
-        audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
         opt_ts = []
-        if audio_pad.shape[0] > self.t_max:
-            audio_sum = np.zeros_like(audio)
-            for i in range(self.window):
-                audio_sum += audio_pad[i : i - self.window]
-            for t in range(self.t_center, audio.shape[0], self.t_center):
-                opt_ts.append(
-                    t
-                    - self.t_query
-                    + np.where(
-                        np.abs(audio_sum[t - self.t_query : t + self.t_query])
-                        == np.abs(audio_sum[t - self.t_query : t + self.t_query]).min()
-                    )[0][0]
-                )
+        if audio.shape[0] + self.window > self.t_max:
+            opt_ts = plan_splits(audio, self.window, self.t_center, self.t_query)
         s = 0
         audio_opt = []
-        t = None
         t1 = ttime()
         audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
         p_len = audio_pad.shape[0] // self.window
@@ -546,16 +721,19 @@ class VC(object):
         sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
         pitch, pitchf = None, None
         if if_f0 == 1:
-            pitch, pitchf = self.get_f0(
-                input_audio_path,
-                audio_pad,
-                p_len,
-                f0_up_key,
-                f0_method,
-                filter_radius,
-                crepe_hop_length,
-                inp_f0,
-            )
+            with measure(meter, "f0") as stage:
+                pitch, pitchf = self.get_f0(
+                    input_audio_path,
+                    audio_pad,
+                    p_len,
+                    f0_up_key,
+                    f0_method,
+                    filter_radius,
+                    crepe_hop_length,
+                    inp_f0,
+                    cache,
+                    stage,
+                )
             pitch = pitch[:p_len]
             pitchf = pitchf[:p_len]
             if self.device == "mps":
@@ -564,76 +742,36 @@ class VC(object):
             pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
         t2 = ttime()
         times[1] += t2 - t1
+        segments = []
         for t in opt_ts:
             t = t // self.window * self.window
-            if if_f0 == 1:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        pitch[:, s // self.window : (t + self.t_pad2) // self.window],
-                        pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            else:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        None,
-                        None,
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
+            segments.append((s, t + self.t_pad2 + self.window, (t + self.t_pad2) // self.window))
             s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
+        segments.append((s, None, None))
+        for i in range(0, len(segments), self.batch_size):
+            batch = segments[i : i + self.batch_size]
+            audio_opt.extend(
+                seg[self.t_pad_tgt : -self.t_pad_tgt]
+                for seg in self.vc_batch(
                     model,
                     net_g,
                     sid,
-                    audio_pad[t:],
-                    pitch[:, t // self.window :] if t is not None else pitch,
-                    pitchf[:, t // self.window :] if t is not None else pitchf,
+                    [audio_pad[start:end] for start, end, _ in batch],
+                    [pitch[:, start // self.window : f0_end] for start, _, f0_end in batch]
+                    if if_f0 == 1
+                    else None,
+                    [pitchf[:, start // self.window : f0_end] for start, _, f0_end in batch]
+                    if if_f0 == 1
+                    else None,
                     times,
                     index,
                     big_npy,
                     index_rate,
                     version,
                     protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        else:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    None,
-                    None,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
+                    feature_cache,
+                    meter,
+                )
             )
         audio_opt = np.concatenate(audio_opt)
         if rms_mix_rate != 1:
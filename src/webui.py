@@ -7,7 +7,9 @@ from argparse import ArgumentParser
 
 import gradio as gr
 
+from index_cache import export_index_vectors
 from main import song_cover_pipeline
+from model_manager import model_manager
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -60,6 +62,7 @@ def extract_zip(extraction_folder, zip_name):
     os.rename(model_filepath, os.path.join(extraction_folder, os.path.basename(model_filepath)))
     if index_filepath:
         os.rename(index_filepath, os.path.join(extraction_folder, os.path.basename(index_filepath)))
+        export_index_vectors(os.path.join(extraction_folder, os.path.basename(index_filepath)))
 
     # remove any unnecessary nested folders
     for filepath in os.listdir(extraction_folder):
@@ -160,8 +163,17 @@ if __name__ == '__main__':
     parser.add_argument("--listen", action="store_true", default=False, help="Make the WebUI reachable from your local network.")
     parser.add_argument('--listen-host', type=str, help='The hostname that the server will use.')
     parser.add_argument('--listen-port', type=int, help='The listening port that the server will use.')
+    parser.add_argument('--threads', type=int, default=0, help='Number of CPU threads shared by vocal separation, HuBERT and index search. 0 uses all cores.')
+    parser.add_argument('--no-preload', action='store_true', default=False, help='Load HuBERT, RMVPE and the MDX models on the first generation instead of at startup.')
     args = parser.parse_args()
 
+    if args.threads:
+        model_manager.set_thread_budget(args.threads)
+
+    if not args.no_preload:
+        with open(os.path.join(mdxnet_models_dir, 'model_data.json')) as infile:
+            model_manager.preload(json.load(infile))
+
     voice_models = get_current_models(rvc_models_dir)
     with open(os.path.join(rvc_models_dir, 'public_models.json'), encoding='utf8') as infile:
         public_models = json.load(infile)